@@ -6,6 +6,7 @@ from src.skills.ponder_wittgenstein_skill import PonderWittgensteinSkill
 from src.skills.get_to_know_you_skill import GetToKnowYouSkill
 from src.models import User
 from src.skills.zettel.file_management_service import FileManagementService
+from src.skills.zettel.topic_maintenance import TopicMaintenanceService
 from src.skills.zettel import LOCAL_DOCS_FOLDER
 from src.skills.zettel import ZettelkastenTopic
 from src.skills.zettel import Zettel
@@ -43,24 +44,31 @@ app.add_url_rule('/skills', view_func=src.views.skills.index)
 def current_user():
     return User.query.filter_by(name=config('ME')).first()
 
+# scheduler jobs run on APScheduler's thread pool, each on its own session
+
 def sync_mailbox():
-    # with app.app_context():
-    check_mailbox()
+    with session_scope():
+        check_mailbox()
 
 def send_enqueued_messages():
-    # with app.app_context():
-    send_next_message_if_bandwidth_available()
+    with session_scope():
+        send_next_message_if_bandwidth_available()
 
 def ask_get_to_know_you():
     # GetToKnowYouSkill.ask_get_to_know_you(me, initial_doc)
-    GetToKnowYouSkill.ask_get_to_know_you_latest_zettelkasten_notes(current_user())
+    with session_scope():
+        GetToKnowYouSkill.ask_get_to_know_you_latest_zettelkasten_notes(current_user())
 
 def ponder_wittgenstein():
-    PonderWittgensteinSkill.ponder_wittgenstein(current_user())
+    with session_scope():
+        PonderWittgensteinSkill.ponder_wittgenstein(current_user())
 
 def sync_local_docs():
-    # with app.app_context():
-    FileManagementService().sync_documents_from_folder(LOCAL_DOCS_FOLDER, current_user())
+    with session_scope():
+        user = current_user()
+        file_management_service = FileManagementService()
+        file_management_service.sync_documents_from_folder(LOCAL_DOCS_FOLDER, user)
+        TopicMaintenanceService(user.id).update_topics_from_file_sync(file_management_service)
 
 app.config['JOBS'] = [
     {
@@ -0,0 +1,48 @@
+"""
+Compares decoding of vector(768) result values.
+
+    python -m benchmarks.vector_result_processor
+
+"regex text" is the previous Vector.result_processor, "numpy text" parses
+pgvector's text output, and "binary" decodes the vector_send bytea that
+Vector now selects.
+"""
+import re
+import struct
+import timeit
+import numpy as np
+from src.models import vector_from_pgvector_binary, vector_from_pgvector_text
+
+
+DIM = 768
+ROWS = 500
+
+
+def regex_text(value):
+    value = value.strip('[]')
+    return [float(x) for x in re.split(r',\s*(?=(?:[^"]*"[^"]*")*[^"]*$)', value)]
+
+
+def main():
+    rng = np.random.default_rng(42)
+    vectors = rng.standard_normal((ROWS, DIM)).astype(np.float32)
+    text_rows = ['[' + ','.join(str(float(x)) for x in vec) + ']' for vec in vectors]
+    binary_rows = [memoryview(struct.pack('>HH', DIM, 0) + vec.astype('>f4').tobytes()) for vec in vectors]
+
+    for row, expected in zip(binary_rows[:10], vectors[:10]):
+        assert np.array_equal(vector_from_pgvector_binary(row), expected)
+
+    cases = [
+        ("regex text", lambda: [regex_text(row) for row in text_rows]),
+        ("numpy text", lambda: [vector_from_pgvector_text(row) for row in text_rows]),
+        ("binary", lambda: [vector_from_pgvector_binary(row) for row in binary_rows]),
+    ]
+    baseline = None
+    for name, fn in cases:
+        seconds = min(timeit.repeat(fn, number=1, repeat=3))
+        baseline = baseline or seconds
+        print(f"{name:>12}: {seconds * 1000:8.1f} ms per {ROWS} rows ({baseline / seconds:5.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
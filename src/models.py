@@ -1,13 +1,16 @@
+from contextlib import contextmanager
 from decouple import config
-import re
+import struct
 import numpy as np
+from typing import Tuple
 from email.utils import getaddresses
 from pyzmail import PyzMessage
-from sqlalchemy import Boolean, create_engine, Column, Integer, String, DateTime, ForeignKey, func
+from sqlalchemy import Boolean, create_engine, Column, Integer, String, DateTime, ForeignKey, LargeBinary, func
 from sqlalchemy.engine.url import URL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, scoped_session, sessionmaker
-from sqlalchemy.sql import text, expression
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import text, expression, type_coerce
 from sqlalchemy.types import UserDefinedType
 from flask_sqlalchemy import SQLAlchemy
 
@@ -27,20 +30,84 @@ POSTGRES_DATABASE_URL = URL.create(
 )
 SQLALCHEMY_DATABASE_URI = POSTGRES_DATABASE_URL.render_as_string(hide_password=False)
 
+# every scheduler job, worker thread and request holds at most one pooled connection
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=10, cast=int)
+DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', default=10, cast=int)
+DB_POOL_TIMEOUT_SECONDS = config('DB_POOL_TIMEOUT_SECONDS', default=30, cast=int)
+DB_POOL_RECYCLE_SECONDS = config('DB_POOL_RECYCLE_SECONDS', default=1800, cast=int)
+
 def init_session():
-    # singleton db session, no multithreading
-    engine = create_engine(POSTGRES_DATABASE_URL.render_as_string(hide_password=False))
+    """
+    One pooled engine for the whole process. db_session is thread-local:
+    each worker thread, scheduler job and request gets its own session,
+    which it should release with db_session.remove() or session_scope.
+    """
+    engine = create_engine(
+        POSTGRES_DATABASE_URL.render_as_string(hide_password=False),
+        poolclass=QueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+        pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        # connections idle in the pool may have been closed by the server
+        pool_pre_ping=True,
+    )
     db_session = scoped_session(sessionmaker(autoflush=True, bind=engine))
     return engine, db_session
 
 engine, db_session = init_session()
 
+@contextmanager
+def session_scope(session: scoped_session = None):
+    """
+    Runs a job or worker task on the calling thread's own session: rolls it
+    back if the block raises, and returns its connection to the pool after.
+    Commits are left to the code in the block.
+    """
+    session = session or db_session
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
+
 Base = declarative_base()
 Base.query = db_session.query_property()
 
-db = SQLAlchemy()
+
+class SharedEngineSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy on the module's engine, so requests and background jobs share one pool"""
+    def _make_engine(self, bind_key, options, app):
+        return engine
+
+db = SharedEngineSQLAlchemy()
+# Model.query goes through the thread-local db_session, inside an app context or not
+db.Model.query = db_session.query_property()
+
+def vector_from_pgvector_binary(value) -> np.ndarray:
+    """
+    Decodes pgvector's binary send format: uint16 dim, uint16 unused, then
+    dim big-endian float4s. The floats are read in place; converting them to
+    native float32 only copies on little-endian hosts.
+    """
+    buf = memoryview(value)
+    (dim,) = struct.unpack_from('>H', buf, 0)
+    return np.frombuffer(buf, dtype='>f4', count=dim, offset=4).astype(np.float32, copy=False)
+
+
+def vector_from_pgvector_text(value: str) -> np.ndarray:
+    return np.array(value.strip('[]').split(','), dtype=np.float32)
+
+
+def vector_to_pgvector_text(value: np.ndarray) -> str:
+    return '[' + ','.join(map(str, value.tolist())) + ']'
+
 
 class Vector(UserDefinedType):
+    cache_ok = True
+
     def __init__(self, dim):
         self.dim = dim
 
@@ -50,29 +117,67 @@ class Vector(UserDefinedType):
     def bind_expression(self, bindvalue):
         return expression.cast(bindvalue, self)
 
+    def column_expression(self, colexpr):
+        # select vector_send(col) so rows arrive as bytea instead of text that needs float parsing
+        return func.vector_send(colexpr, type_=self)
+
+    def compare_values(self, x, y):
+        if x is None or y is None:
+            return x is y
+        return np.array_equal(x, y)
+
     def bind_processor(self, _dialect):
         def process(value):
             if value is None:
                 return None
             if isinstance(value, list):
                 return value
-            raise ValueError("Vector values must be lists")
+            if isinstance(value, np.ndarray):
+                if value.shape != (self.dim,):
+                    raise ValueError(f"Vector values must have shape ({self.dim},), got {value.shape}")
+                return vector_to_pgvector_text(value)
+            raise ValueError("Vector values must be lists or numpy arrays")
         return process
 
     def result_processor(self, _dialect, _coltype):
         def process(value):
             if value is None:
                 return None
-            value = value.strip('[]')
-            return [float(x) for x in re.split(r',\s*(?=(?:[^"]*"[^"]*")*[^"]*$)', value)]
+            if isinstance(value, str):
+                return vector_from_pgvector_text(value)
+            return vector_from_pgvector_binary(value)
         return process
 
 
+def load_vector_matrix(id_column, vector_column, *criteria) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (ids, matrix) for the rows matching criteria that have a vector,
+    where matrix is a contiguous (N, dim) float32 array. No ORM objects are
+    created: the vector_send payloads are joined and decoded in one go.
+    """
+    dim = vector_column.type.dim
+    rows = db_session.query(id_column, type_coerce(func.vector_send(vector_column), LargeBinary))\
+        .filter(vector_column.isnot(None), *criteria)\
+        .order_by(id_column)\
+        .all()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    if len(rows) == 0:
+        return ids, np.empty((0, dim), dtype=np.float32)
+    payload = b''.join(bytes(row[1]) for row in rows)
+    # each payload is a 4 byte header followed by dim float4s, so every row is dim + 1 float-sized slots
+    matrix = np.frombuffer(payload, dtype='>f4').reshape(len(rows), dim + 1)[:, 1:]
+    return ids, np.ascontiguousarray(matrix, dtype=np.float32)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
 def cosine_similarity(a, b):
-    if not isinstance(a, np.ndarray):
-        a = np.array(a)
-    if not isinstance(b, np.ndarray):
-        b = np.array(b)
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
 
     dot_product = np.dot(a, b)
     norm_a = np.linalg.norm(a)
@@ -1,21 +1,20 @@
-import chromadb
 from datetime import datetime
 from decouple import config
 from hashlib import sha256
-from InstructorEmbedding import INSTRUCTOR
 import os
 import requests
 import uuid6
 from src.openai_client import OpenAIClient
 from src.email_inbox import EmailInbox
 from src.models import db_session
+from src.skills.model_registry import DEFAULT_EMBEDDINGS_MODEL_NAME, LazyProxy, ModelRegistry
 
 EMAIL_ADDRESS = config('EMAIL_ADDRESS')
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-documents_collection_path = config('DOCUMENTS_COLLECTION_PATH', default="./documents_collection")
-chroma_client = chromadb.PersistentClient(path=documents_collection_path)
-default_embeddings_model = INSTRUCTOR('hkunlp/instructor-base')
+# both load on first use, see ModelRegistry
+chroma_client = LazyProxy(ModelRegistry.chroma_client)
+default_embeddings_model = LazyProxy(ModelRegistry.embeddings_model)
 
 class SkillBase(object):
     llm_client = OpenAIClient()
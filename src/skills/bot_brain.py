@@ -1,11 +1,12 @@
-from src.skills.base import DocumentsBase, chroma_client, default_embeddings_model
+from src.skills.base import DocumentsBase
+from src.skills.embedding_service import EmbeddingService
+from src.skills.model_registry import lazy_collection
 
 def botbrain_note_embed(doc_string):
     instruction = "Represent this note written about the user's preferences and personality: "
-    vec = default_embeddings_model.encode([[instruction, doc_string[0]]]).tolist()
-    return vec
+    return EmbeddingService.encode(instruction, doc_string).tolist()
 
-botbrain_collection = chroma_client.get_or_create_collection(name="botbrain_collection", embedding_function=botbrain_note_embed)
+botbrain_collection = lazy_collection("botbrain_collection", botbrain_note_embed)
 
 '''
 BotBrain document
@@ -2,31 +2,29 @@ from src.models import db_session, User
 from .oauth_credential import OAuthCredential
 from .gmail_client import GmailClient
 from .email import Email
+from .gmail_sync_cursor import GmailSyncCursor
+from .mailbox_sync import sync_mailboxes
 from .enqueued_message import EnqueuedMessage
 from .message_queue import MessageQueue
+from .outgoing_message_scheduler import OutgoingMessageScheduler
 from .email_event_bus import EmailEventBus
 from .views import email_bp
 from .hello_world_test import enqueue_test_message
 
 def check_mailbox():
     print("checking mailbox...")
-    users_with_credentials = db_session.query(User).join(OAuthCredential).all()
-    if len(users_with_credentials) == 0:
+    user_ids = [user_id for (user_id,) in db_session.query(User.id).join(OAuthCredential).all()]
+    if len(user_ids) == 0:
         print("no users with credentials found")
-    for user in users_with_credentials:
-        gmail_client = GmailClient(user_id=user.id)
-        gmail_client.fetch_emails_full_sync()
+    sync_mailboxes(user_ids)
     EmailEventBus.process_unhandled_emails()
 
 def full_sync(user_id):
-    gmail_client = GmailClient(user_id=user_id)
+    gmail_client = GmailClient.for_user(user_id)
     gmail_client.fetch_emails_full_sync(update_existing_records=True)
 
 def send_next_message_if_bandwidth_available():
-    user_id = 1
-    message_queues = MessageQueue.query.filter_by(user_id=user_id).all()
-    for message_queue in message_queues:
-        message_queue.send_next_message_if_bandwidth_available()
+    OutgoingMessageScheduler().run()
 
 def register_routes(app):
     app.register_blueprint(email_bp)
@@ -1,5 +1,7 @@
 from datetime import datetime
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, ForeignKey
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text, ForeignKey, literal_column
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import relationship
 from src.models import db, db_session
 
@@ -23,15 +25,25 @@ class Email(db.Model):
     history_id = Column(String, nullable=True) # used for partial sync
     received_at = Column(DateTime, nullable=False)
     message_id = Column(String, nullable=True)
+    # reply body parsed from the full message, valid while history_id == parsed_content_history_id
+    parsed_content = Column(Text, nullable=True)
+    parsed_content_history_id = Column(String, nullable=True)
+    # listener dispatch bookkeeping, see EmailDispatcher
+    dispatch_attempts = Column(Integer, default=0, server_default='0', nullable=False)
+    next_dispatch_at = Column(DateTime, nullable=True)
+    dispatch_failed_at = Column(DateTime, nullable=True) # set once retries are exhausted, the email is dead-lettered
+    last_dispatch_error = Column(Text, nullable=True)
 
     def __repr__(self):
         return f"<Email(id={self.id}, gmail_id={self.gmail_id}, from_email_address='{self.from_email_address}', subject='{self.subject}')>"
 
+    # columns written from Gmail; everything else (is_processed, ...) is ours and left alone on update
+    GMAIL_ATTRIBUTES = ['user_id', 'thread_id', 'snippet', 'from_email_address', 'to_email_address', 'subject', 'history_id', 'received_at', 'message_id']
+
     @classmethod
-    def from_raw_gmail(cls, raw_email, user_id):
-        payload = raw_email["payload"]
-        headers = payload["headers"]
-        email_instance = Email(
+    def attributes_from_raw_gmail(cls, raw_email, user_id) -> Dict[str, Any]:
+        headers = raw_email["payload"]["headers"]
+        return dict(
             user_id=user_id,
             gmail_id=raw_email["id"],
             thread_id=raw_email["threadId"],
@@ -43,28 +55,58 @@ class Email(db.Model):
             received_at=cls.internal_date_to_received_at(raw_email["internalDate"]),
             message_id=next((p["value"] for p in headers if p["name"].lower() == "message-id")),
         )
+
+    @classmethod
+    def from_raw_gmail(cls, raw_email, user_id):
+        email_instance = Email(**cls.attributes_from_raw_gmail(raw_email, user_id))
         db_session.add(email_instance)
         db_session.commit()
         return email_instance
 
     def update_from_raw_gmail(self, raw_email, user_id):
         instance = db_session.merge(self)
+        for attribute, value in self.attributes_from_raw_gmail(raw_email, user_id).items():
+            setattr(instance, attribute, value)
+        db_session.add(instance)
+        db_session.commit()
 
-        payload = raw_email["payload"]
-        headers = payload["headers"]
+    @classmethod
+    def upsert_statement(cls, rows: List[Dict[str, Any]]):
+        """INSERT ... ON CONFLICT (gmail_id) DO UPDATE returning each row's id and whether it was inserted"""
+        statement = insert(cls).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=[cls.gmail_id],
+            set_={attribute: statement.excluded[attribute] for attribute in cls.GMAIL_ATTRIBUTES},
+        ).returning(
+            cls.id,
+            # xmax is only set on rows written by the update branch
+            literal_column("xmax = 0").label("inserted"),
+        )
+
+    @classmethod
+    def bulk_upsert_from_raw_gmail(cls, raw_emails: List[Dict[str, Any]], user_id) -> Tuple[int, int]:
+        """
+        Writes a page of raw Gmail messages in one statement, without
+        committing. Returns (number inserted, number updated).
+        """
+        # one row per gmail_id, ON CONFLICT cannot touch the same row twice in one statement
+        rows = list({raw_email["id"]: cls.attributes_from_raw_gmail(raw_email, user_id) for raw_email in raw_emails}.values())
+        if len(rows) == 0:
+            return 0, 0
+        results = db_session.execute(cls.upsert_statement(rows)).all()
+        inserted = sum(1 for result in results if result.inserted)
+        return inserted, len(results) - inserted
 
-        instance.user_id = user_id
-        instance.thread_id=raw_email["threadId"]
-        instance.snippet=raw_email["snippet"]
-        instance.from_email_address=next((p["value"] for p in headers if p["name"].lower() == "from"))
-        instance.to_email_address=next((p["value"] for p in headers if p["name"].lower() == "to"))
-        instance.subject=next((p["value"] for p in headers if p["name"].lower() == "subject"))
-        instance.history_id=raw_email["historyId"]
-        instance.received_at=self.internal_date_to_received_at(raw_email["internalDate"])
-        instance.message_id=next((p["value"] for p in headers if p["name"].lower() == "message-id"))
+    @property
+    def cached_content(self) -> Optional[str]:
+        if self.parsed_content is not None and self.parsed_content_history_id == self.history_id:
+            return self.parsed_content
+        return None
 
-        db_session.add(instance)
-        db_session.commit()
+    def cache_content(self, content: Optional[str]):
+        # a message without a text body is cached as "", so it is not fetched again
+        self.parsed_content = content or ""
+        self.parsed_content_history_id = self.history_id
 
     @classmethod
     def internal_date_to_received_at(cls, internal_date):
@@ -1,9 +1,16 @@
-from src.models import db, db_session
-from sqlalchemy import Column, Integer, String, DateTime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Set, Tuple
+from decouple import config
+from src.models import db, db_session, session_scope
+from sqlalchemy import Column, Integer, String, DateTime, exists
+from sqlalchemy.orm import aliased
 from sqlalchemy.sql import func
 from .email import Email
+import importlib
 import traceback
-import sys
 import logging
 
 
@@ -20,48 +27,201 @@ class EmailCommandListener(db.Model):
 
 
 class EmailEventBus:
+    # listener_function strings resolved to callables, imported once per process
+    _listener_functions: Dict[str, Callable[[Email], None]] = {}
+
     @classmethod
     def register_listener(cls, gmail_thread_id: str, listener_function: str):
-        print(f"Registering listener {listener_function} for thread {gmail_thread_id}")
-        listener = db_session.query(EmailCommandListener).filter_by(gmail_thread_id=gmail_thread_id).first()
-        if listener:
-            listener.listener_function = listener_function
-        else:
-            listener = EmailCommandListener(
-                gmail_thread_id=gmail_thread_id,
-                listener_function=listener_function
-            )
-        db_session.add(listener)
+        cls.register_listeners([(gmail_thread_id, listener_function)])
         db_session.commit()
 
     @classmethod
-    def dispatch_email(cls, email: Email):
+    def register_listeners(cls, registrations: List[Tuple[str, str]]):
+        """
+        Adds or replaces the listener of each (gmail thread id, listener function), loading the
+        existing listeners in one query. Registrations without a function leave the thread's
+        listener as it was. Does not commit.
+        """
+        listener_by_thread = {thread_id: function for thread_id, function in registrations if function is not None}
+        if len(listener_by_thread) == 0:
+            return
+        existing = db_session.query(EmailCommandListener)\
+            .filter(EmailCommandListener.gmail_thread_id.in_(list(listener_by_thread)))\
+            .all()
+        existing_by_thread = {listener.gmail_thread_id: listener for listener in existing}
+        for thread_id, listener_function in listener_by_thread.items():
+            print(f"Registering listener {listener_function} for thread {thread_id}")
+            listener = existing_by_thread.get(thread_id)
+            if listener:
+                listener.listener_function = listener_function
+            else:
+                db_session.add(EmailCommandListener(gmail_thread_id=thread_id, listener_function=listener_function))
+
+    @classmethod
+    def resolve_listener_function(cls, listener_function: str) -> Callable[[Email], None]:
+        listener_fn = cls._listener_functions.get(listener_function)
+        if listener_fn is None:
+            module_name, function_name = listener_function.rsplit('.', 1)
+            listener_fn = getattr(importlib.import_module(module_name), function_name)
+            cls._listener_functions[listener_function] = listener_fn
+        return listener_fn
+
+    @classmethod
+    def process_unhandled_emails(cls):
+        """
+        Marks every unprocessed email without a listener as processed in one
+        UPDATE, then hands the emails that are due to an EmailDispatcher.
+        """
+        has_listener = exists().where(EmailCommandListener.gmail_thread_id == Email.thread_id)
+        num_without_listener = db_session.query(Email)\
+            .filter(Email.is_processed == False, ~has_listener)\
+            .update({Email.is_processed: True}, synchronize_session=False)
+        db_session.commit()
+        print(f"Marked {num_without_listener} emails without a listener as processed")
+
+        now = datetime.utcnow()
+        # a thread's emails are handled in order, so a thread waits while one of its emails backs off
+        backing_off = aliased(Email)
+        thread_is_backing_off = exists().where(
+            backing_off.thread_id == Email.thread_id,
+            backing_off.is_processed == False,
+            backing_off.dispatch_failed_at.is_(None),
+            backing_off.next_dispatch_at > now,
+        )
+        due_emails = db_session.query(Email.id, Email.thread_id, EmailCommandListener.listener_function)\
+            .join(EmailCommandListener, EmailCommandListener.gmail_thread_id == Email.thread_id)\
+            .filter(
+                Email.is_processed == False,
+                Email.dispatch_failed_at.is_(None),
+                ~thread_is_backing_off,
+            )\
+            .order_by(Email.received_at)\
+            .all()
+        db_session.commit()
+        EmailDispatcher().dispatch(due_emails)
+
+
+LISTENER_WORKERS = config('LISTENER_WORKERS', default=4, cast=int)
+LISTENER_TIMEOUT_SECONDS = config('LISTENER_TIMEOUT_SECONDS', default=300, cast=float)
+MAX_DISPATCH_ATTEMPTS = 5
+DISPATCH_BACKOFF_SECONDS = 60
+
+
+class EmailDispatcher:
+    """
+    Runs listeners on a thread pool, one Gmail thread per task so a thread's
+    emails stay in order while a slow thread cannot hold up the others.
+
+    A failed listener is retried on a later tick after an exponential
+    backoff, and dead-lettered after max_attempts. A listener still running
+    after timeout_seconds is not a failure: Python cannot stop its thread,
+    and listeners commit their own side effects, so dispatching the email
+    again would repeat them. The dispatcher stops waiting for it instead,
+    and its Gmail thread is skipped by every later dispatch until the
+    listener returns and its outcome is recorded as usual.
+    """
+    poll_seconds = 1.0
+    # Gmail threads with a listener running in this process, across dispatcher instances
+    _in_flight_threads: Set[str] = set()
+    _in_flight_lock = threading.Lock()
+
+    def __init__(self, max_workers: int = LISTENER_WORKERS, timeout_seconds: float = LISTENER_TIMEOUT_SECONDS,
+                 max_attempts: int = MAX_DISPATCH_ATTEMPTS, backoff_seconds: float = DISPATCH_BACKOFF_SECONDS) -> None:
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._lock = threading.Lock()
+        self._started_at: Dict[int, float] = {}
+        self._timed_out: Set[int] = set()
+
+    def dispatch(self, due_emails: List[Tuple[int, str, str]]):
+        """due_emails are (email id, gmail thread id, listener function) in the order they should run"""
+        by_thread: Dict[str, List[Tuple[int, str]]] = {}
+        with self._in_flight_lock:
+            for email_id, thread_id, listener_function in due_emails:
+                if thread_id not in self._in_flight_threads:
+                    by_thread.setdefault(thread_id, []).append((email_id, listener_function))
+            self._in_flight_threads.update(by_thread)
+        if len(by_thread) == 0:
+            return
+
+        workers = min(self.max_workers, len(by_thread))
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="email-listener")
+        futures = {pool.submit(self.dispatch_thread, thread_id, emails): thread_id for thread_id, emails in by_thread.items()}
+        try:
+            while True:
+                _done, not_done = wait(futures, timeout=self.poll_seconds)
+                self.log_timed_out_listeners()
+                if len(not_done) == 0:
+                    break
+                with self._lock:
+                    stuck = len(self._timed_out & set(self._started_at))
+                # every worker is stuck on a timed out listener, leave the rest for the next tick
+                if stuck >= min(len(not_done), workers):
+                    print(f"{len(not_done)} threads left for the next run, listeners timed out")
+                    break
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            with self._in_flight_lock:
+                for future, thread_id in futures.items():
+                    if future.cancelled():
+                        self._in_flight_threads.discard(thread_id)
+
+    def dispatch_thread(self, thread_id: str, emails: List[Tuple[int, str]]):
+        try:
+            with session_scope(db_session):
+                for email_id, listener_function in emails:
+                    if not self.dispatch_one(email_id, listener_function):
+                        # the thread's later emails wait for this one
+                        break
+        finally:
+            with self._in_flight_lock:
+                self._in_flight_threads.discard(thread_id)
+
+    def dispatch_one(self, email_id: int, listener_function: str) -> bool:
+        email = db_session.get(Email, email_id)
         print(f"Dispatching email with thread_id: {email.thread_id}")
-        listener = db_session.query(EmailCommandListener).filter_by(gmail_thread_id=email.thread_id).first()
-        if listener:
-            try:
-                module_name, function_name = listener.listener_function.rsplit('.', 1)
-                module = __import__(module_name, fromlist=[function_name])
-                listener_fn = getattr(module, function_name)
-
-                listener_fn(email)
-
-                email.is_processed = True
-                db_session.commit()
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                logging.error("Error dispatching email:")
-                logging.error(f"Exception type: {exc_type.__name__}")
-                logging.error(f"Exception message: {str(e)}")
-                logging.error("Traceback:")
-                logging.error(traceback.format_exc())
-        else:
-            print(f"No listener found for email thread {email.thread_id}")
+        with self._lock:
+            self._started_at[email_id] = time.monotonic()
+        try:
+            EmailEventBus.resolve_listener_function(listener_function)(email)
+            error = None
+        except Exception as e:
+            error = e
+            logging.error(f"Error dispatching email {email_id}:")
+            logging.error(traceback.format_exc())
+        finally:
+            with self._lock:
+                del self._started_at[email_id]
+        if error is None:
             email.is_processed = True
             db_session.commit()
+            return True
+        db_session.rollback()
+        self.record_failure(email_id, f"{type(error).__name__}: {error}")
+        return False
 
-    @classmethod
-    def process_unhandled_emails(cls):
-        unprocessed_emails = db_session.query(Email).filter_by(is_processed=False).all()
-        for email in unprocessed_emails:
-            EmailEventBus.dispatch_email(email)
+    def log_timed_out_listeners(self):
+        now = time.monotonic()
+        with self._lock:
+            timed_out = [
+                email_id for email_id, started_at in self._started_at.items()
+                if now - started_at > self.timeout_seconds and email_id not in self._timed_out
+            ]
+            self._timed_out.update(timed_out)
+        for email_id in timed_out:
+            print(f"Listener for email {email_id} still running after {self.timeout_seconds}s, its thread is skipped until it returns")
+
+    def record_failure(self, email_id: int, error: str):
+        email = db_session.get(Email, email_id)
+        email.dispatch_attempts = (email.dispatch_attempts or 0) + 1
+        email.last_dispatch_error = error
+        if email.dispatch_attempts >= self.max_attempts:
+            email.dispatch_failed_at = datetime.utcnow()
+            print(f"Dead-lettered email {email_id} after {email.dispatch_attempts} attempts: {error}")
+        else:
+            delay = self.backoff_seconds * (2 ** (email.dispatch_attempts - 1))
+            email.next_dispatch_at = datetime.utcnow() + timedelta(seconds=delay)
+            print(f"Listener failed for email {email_id}, retrying in {delay:.0f}s: {error}")
+        db_session.commit()
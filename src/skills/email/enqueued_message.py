@@ -1,12 +1,17 @@
+from typing import Dict, List
 from src.models import db, db_session
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, case
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 from datetime import datetime
 
 
 class EnqueuedMessage(db.Model):
     __tablename__ = 'enqueued_messages'
+    __table_args__ = (
+        # only unsent messages are ever looked up by queue, so sent history stays out of the index
+        Index('ix_enqueued_messages_pending_queue_id_created_at', 'queue_id', 'created_at', postgresql_where=text('sent_at IS NULL')),
+    )
 
     id = Column(Integer, primary_key=True)
     content = Column(Text, nullable=False)
@@ -24,7 +29,28 @@ class EnqueuedMessage(db.Model):
     def __repr__(self):
         return f'<EnqueuedMessage {self.id}>'
     
-    def mark_as_sent(self, email_thread_id: str):
-        self.sent_at = datetime.now()
+    @classmethod
+    def pending_for_queues(cls, budget_by_queue: Dict[int, float], limit_per_queue: int = 20) -> List["EnqueuedMessage"]:
+        """
+        The oldest limit_per_queue unsent messages of each queue that fit in
+        that queue's budget of minutes, in one query. Messages too long for
+        the budget are left out before the limit, so they cannot crowd out
+        shorter ones queued after them.
+        """
+        if len(budget_by_queue) == 0:
+            return []
+        fits_budget = cls.estimated_time <= case(budget_by_queue, value=cls.queue_id)
+        position = func.row_number().over(partition_by=cls.queue_id, order_by=(cls.created_at, cls.id)).label('position')
+        ranked = db_session.query(cls.id.label('id'), position)\
+            .filter(cls.queue_id.in_(list(budget_by_queue)), cls.sent_at == None, fits_budget)\
+            .subquery()
+        return db_session.query(cls)\
+            .join(ranked, ranked.c.id == cls.id)\
+            .filter(ranked.c.position <= limit_per_queue)\
+            .order_by(cls.queue_id, cls.created_at, cls.id)\
+            .all()
+
+    def mark_as_sent(self, email_thread_id: str, sent_at: datetime = None):
+        """Does not commit, the sender records a whole batch in one transaction"""
+        self.sent_at = sent_at or datetime.now()
         self.email_thread_id = email_thread_id
-        db_session.commit()
@@ -1,10 +1,17 @@
-from typing import List, Dict, Any
+import threading
+import time
+from typing import List, Dict, Any, Iterable, Tuple
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, build_http
 from .email import Email
 from .oauth_credential import OAuthCredential
 from .enqueued_message import EnqueuedMessage
+from .gmail_sync_cursor import GmailSyncCursor
 from src.models import db_session
 from email.mime.text import MIMEText
 import base64
@@ -13,36 +20,168 @@ from decouple import config
 from email.mime.multipart import MIMEMultipart
 
 
-flow = Flow.from_client_secrets_file(
-    'client_secret.apps.googleusercontent.com.json',
-    scopes=[
-        'https://www.googleapis.com/auth/gmail.readonly', 
-        'https://www.googleapis.com/auth/gmail.modify', 
-        'https://www.googleapis.com/auth/gmail.send'
-    ],
-    redirect_uri='http://localhost:5000/email/oauth2callback',
-)
+_flow = None
+
+def oauth_flow() -> Flow:
+    # created on first use, so importing this module does not need the client secret file
+    global _flow
+    if _flow is None:
+        _flow = Flow.from_client_secrets_file(
+            'client_secret.apps.googleusercontent.com.json',
+            scopes=[
+                'https://www.googleapis.com/auth/gmail.readonly', 
+                'https://www.googleapis.com/auth/gmail.modify', 
+                'https://www.googleapis.com/auth/gmail.send'
+            ],
+            redirect_uri='http://localhost:5000/email/oauth2callback',
+        )
+    return _flow
+
+_gmail_discovery_document = None
+
+def gmail_discovery_document() -> str:
+    # the discovery document bundled with googleapiclient, read once per process instead of fetched per client
+    global _gmail_discovery_document
+    if _gmail_discovery_document is None:
+        _gmail_discovery_document = get_static_doc('gmail', 'v1')
+    return _gmail_discovery_document
+
 BOT_EMAIL_ADDRESS = config("EMAIL_ADDRESS")
+# Gmail accepts up to 100 requests per batch, but rate limits batches larger than 50
+GMAIL_BATCH_SIZE = 50
+GMAIL_BATCH_MAX_ATTEMPTS = 4
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# the only headers Email.from_raw_gmail reads
+SYNC_METADATA_HEADERS = ['From', 'To', 'Subject', 'Message-ID']
 
 class GmailClient():
-    def __init__(self, user_id=None) -> None:
+    # one client per user for the whole process, see for_user
+    _clients: Dict[int, "GmailClient"] = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, user_id=None, gmail_service=None, sync_format='metadata') -> None:
+        """
+        sync_format is the messages.get format used while syncing. 'metadata'
+        skips bodies and attachments, which get_email_content fetches on demand.
+        Prefer GmailClient.for_user, which reuses clients.
+        """
+        self.user_id = user_id
+        self.sync_format = sync_format
+        if gmail_service is not None:
+            self.gmail_service = gmail_service
+            return
         # TODO: OauthCredential should not be per user, but per bot email address
         self.credentials = db_session.query(OAuthCredential).filter_by(user_id=user_id).first().to_credentials()
-        self.user_id = user_id
-        self.gmail_service = build('gmail', 'v1', credentials=self.credentials)
+        self.persisted_token = self.credentials.token
+        self._local = threading.local()
+        self.gmail_service = build_from_document(
+            gmail_discovery_document(),
+            credentials=self.credentials,
+            requestBuilder=self._build_request,
+        )
+
+    @classmethod
+    def for_user(cls, user_id) -> "GmailClient":
+        """
+        Returns the cached client for user_id, creating it on first use, with
+        its access token refreshed if it has expired. Safe to share between
+        threads: every thread sends requests through its own connection.
+        """
+        with cls._clients_lock:
+            client = cls._clients.get(user_id)
+            if client is None:
+                client = cls(user_id=user_id)
+                cls._clients[user_id] = client
+        client.ensure_fresh_credentials()
+        return client
+
+    @classmethod
+    def forget(cls, user_id):
+        with cls._clients_lock:
+            cls._clients.pop(user_id, None)
+
+    def ensure_fresh_credentials(self):
+        """Refreshes an expired access token, and stores any token refreshed since the last call"""
+        if not self.credentials.valid and self.credentials.refresh_token:
+            self.credentials.refresh(Request())
+        if self.credentials.token != self.persisted_token:
+            OAuthCredential.store_refreshed_credentials(self.user_id, self.credentials)
+            self.persisted_token = self.credentials.token
+
+    def _build_request(self, _http, *args, **kwargs):
+        # httplib2 connections are not thread-safe, so each thread gets its own
+        http = getattr(self._local, "http", None)
+        if http is None:
+            # build_http sets the socket timeout and 308 handling build() would have used
+            http = AuthorizedHttp(self.credentials, http=build_http())
+            self._local.http = http
+        return HttpRequest(http, *args, **kwargs)
 
     def messages(self):
         results = self.gmail_service.users().messages().list(userId='me', maxResults=10).execute()
         return results.get('messages', [])
 
-    def get_message(self, email_id: str) -> Dict[str, Any]:
-        return self.gmail_service.users().messages().get(userId='me', id=email_id).execute()
-
-    def get_thread(self, thread_id: str) -> Dict[str, Any]:
-        return self.gmail_service.users().threads().get(userId='me', id=thread_id).execute()['messages']
+    def get_message(self, email_id: str, format: str = 'full') -> Dict[str, Any]:
+        return self._get_message_request(email_id, format).execute()
+
+    def _get_message_request(self, email_id: str, format: str):
+        if format == 'metadata':
+            return self.gmail_service.users().messages().get(userId='me', id=email_id, format='metadata', metadataHeaders=SYNC_METADATA_HEADERS)
+        return self.gmail_service.users().messages().get(userId='me', id=email_id, format=format)
+
+    def get_messages(self, email_ids: Iterable[str], format: str = 'full') -> Dict[str, Dict[str, Any]]:
+        """
+        Fetches messages GMAIL_BATCH_SIZE at a time with the batch HTTP API.
+        Returns raw messages by id. Rate limited and failed requests are
+        retried with backoff; messages that no longer exist are left out.
+        """
+        raw_emails = {}
+        pending = list(dict.fromkeys(email_ids))
+        for attempt in range(GMAIL_BATCH_MAX_ATTEMPTS):
+            if len(pending) == 0:
+                break
+            if attempt > 0:
+                time.sleep(2 ** attempt)
+            retry = []
+            for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+                retry.extend(self._execute_get_batch(pending[start:start + GMAIL_BATCH_SIZE], format, raw_emails))
+            pending = retry
+        if pending:
+            print(f"Gave up fetching {len(pending)} messages: {pending}")
+        return raw_emails
+
+    def _execute_get_batch(self, email_ids: List[str], format: str, raw_emails: Dict[str, Dict[str, Any]]) -> List[str]:
+        """Fetches one batch into raw_emails and returns the ids worth retrying"""
+        retry = []
+
+        def on_response(request_id, response, exception):
+            if exception is None:
+                raw_emails[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUS_CODES:
+                retry.append(request_id)
+            else:
+                print(f"Unable to fetch message {request_id}: {exception}")
+
+        batch = self.gmail_service.new_batch_http_request(callback=on_response)
+        for email_id in email_ids:
+            batch.add(self._get_message_request(email_id, format), request_id=email_id)
+        batch.execute()
+        return retry
+
+    def get_thread(self, thread_id: str, format: str = 'full') -> List[Dict[str, Any]]:
+        return self.gmail_service.users().threads().get(userId='me', id=thread_id, format=format).execute()['messages']
     
     def get_email_content(self, email: Email) -> str:
-        gmail_message = self.get_message(email.gmail_id)
+        content = email.cached_content
+        if content is not None:
+            return content
+        content = self.parse_email_content(self.get_message(email.gmail_id, format='full'))
+        # flushed, not committed: the caller's unit of work decides whether the cache is kept
+        email.cache_content(content)
+        db_session.flush()
+        return email.parsed_content
+
+    def parse_email_content(self, gmail_message: Dict[str, Any]) -> str:
         if "parts" not in gmail_message["payload"]:
             return self.part_as_email_content(gmail_message["payload"])
 
@@ -54,17 +193,47 @@ class GmailClient():
         return "\n\n---\n\n".join(messages)
 
     def thread_as_chat_history(self, thread_id: str) -> List[Dict[str, str]]:
-        emails_in_thread = Email.query.filter_by(thread_id=thread_id).order_by(Email.received_at).all()
+        emails_in_thread = self.emails_in_thread(thread_id)
+        # a thread whose bodies are all cached needs no request at all, otherwise one threads.get
+        if len(emails_in_thread) == 0 or any(email.cached_content is None for email in emails_in_thread):
+            self.cache_thread(thread_id)
+            emails_in_thread = self.emails_in_thread(thread_id)
+
         messages = []
         for email in emails_in_thread:
-            msg = self.get_email_content(email)
-            if msg is not None:
+            msg = email.cached_content
+            if msg:
                 messages.append({ 
                     "role": "assistant" if email.from_email_address == BOT_EMAIL_ADDRESS else "user",
                     "content": msg 
                 })
         return messages
 
+    def emails_in_thread(self, thread_id: str) -> List[Email]:
+        return db_session.query(Email).filter_by(thread_id=thread_id).order_by(Email.received_at).all()
+
+    def cache_thread(self, thread_id: str):
+        """
+        Fetches a whole thread with one threads.get, creates the Email rows
+        that have not been synced yet and caches every message's parsed body.
+        Flushes, the caller commits.
+        """
+        raw_emails = self.get_thread(thread_id)
+        gmail_ids = [raw_email["id"] for raw_email in raw_emails]
+        known_gmail_ids = {
+            gmail_id for (gmail_id,) in db_session.query(Email.gmail_id).filter(Email.gmail_id.in_(gmail_ids)).all()
+        }
+        missing = [raw_email for raw_email in raw_emails if raw_email["id"] not in known_gmail_ids]
+        if missing:
+            Email.bulk_upsert_from_raw_gmail(missing, self.user_id)
+
+        emails = {email.gmail_id: email for email in db_session.query(Email).filter(Email.gmail_id.in_(gmail_ids)).all()}
+        for raw_email in raw_emails:
+            email = emails.get(raw_email["id"])
+            if email is not None and email.cached_content is None:
+                email.cache_content(self.parse_email_content(raw_email))
+        db_session.flush()
+
     def part_as_email_content(self, part: Dict[str, Any]) -> str:
         if (part["mimeType"] == "text/plain" or part["mimeType"] == "text/html") and "body" in part:
             email_content = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
@@ -74,71 +243,83 @@ class GmailClient():
             actual_message = parsed_email.reply
             return actual_message
 
-    def fetch_emails(self) -> List[Email]:
-        return self.fetch_emails_partial_sync()
+    def fetch_emails(self) -> int:
+        return self.sync()
 
-    def fetch_emails_partial_sync(self) -> List[Email]:
-        latest_email = db_session.query(Email).order_by(Email.received_at.desc()).first()
-        history_id = latest_email.history_id
+    def sync(self) -> int:
+        """
+        Syncs the changes since the user's stored history cursor, or the whole
+        mailbox if there is no cursor yet or it has expired. Returns the
+        number of emails created.
+        """
+        history_id = GmailSyncCursor.history_id_for(self.user_id)
         if history_id is None:
             return self.fetch_emails_full_sync()
-
         try:
-            # https://developers.google.com/gmail/api/guides/sync#partial_synchronization
-            results = self.gmail_service.users().history().list(userId="me", startHistoryId=latest_email.history_id).execute()
-            nextPageToken = results.get("nextPageToken", None)
-            messages = results.get('messages', [])
+            return self.fetch_emails_partial_sync(history_id)
+        except HttpError as e:
+            # history records are only kept for about a week
+            if e.resp.status != 404:
+                raise
+            print(f"History cursor {history_id} expired. Running full sync")
+            return self.fetch_emails_full_sync()
 
-            new_emails = []
-            updated_emails = []
-            while (len(messages) > 0):
-                print(f"page size of {len(messages)}")
-                for message in messages:
-                    raw_email = self.get_message(message['id'])
-
-                    existing_email = Email.query.filter_by(gmail_id=message["id"]).first()
-                    if existing_email is not None:
-                        existing_email.update_from_raw_gmail(raw_email)
-                        updated_emails.append(existing_email)
-                        continue
-
-                    email = Email.from_raw_gmail(raw_email, self.user_id)
-                    new_emails.append(email)
-                if nextPageToken is None:
-                    break
-
-                results = self.gmail_service.users().history().list(userId="me", startHistoryId=latest_email.history_id, pageToken=nextPageToken).execute()
-                nextPageToken = results.get("nextPageToken", None)
-                messages = results.get('messages', [])
-
-            print(f"Updated {len(updated_emails)} emails")
-            print(f"Created {len(new_emails)} new emails")
-        except HttpError:
-            print("Unable to do partial sync. Running full sync")
-            self.fetch_emails_full_sync(update_existing_records=False)
-
-    def fetch_emails_full_sync(self, update_existing_records=False) -> List[Email]:
+    def fetch_emails_partial_sync(self, start_history_id: str) -> int:
+        """
+        Syncs messages added, or whose labels changed, after start_history_id
+        and moves the cursor forward. Raises HttpError 404 if start_history_id
+        is too old. Returns the number of emails created.
+        """
+        # https://developers.google.com/gmail/api/guides/sync#partial_synchronization
+        num_created = 0
+        num_updated = 0
+        page_token = None
+        while True:
+            results = self.gmail_service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded', 'labelAdded'],
+                pageToken=page_token,
+            ).execute()
+            gmail_ids = self.changed_message_ids(results.get('history', []))
+            if gmail_ids:
+                print(f"{len(gmail_ids)} changed messages")
+                created, updated = self.sync_messages(gmail_ids, update_existing_records=True)
+                num_created += created
+                num_updated += updated
+            page_token = results.get('nextPageToken')
+            if page_token is None:
+                break
+
+        # the last page's historyId is the mailbox's current one
+        GmailSyncCursor.create_or_update(self.user_id, results['historyId'])
+        print(f"Updated {num_updated} emails")
+        print(f"Created {num_created} new emails")
+        return num_created
+
+    @classmethod
+    def changed_message_ids(cls, history: List[Dict[str, Any]]) -> List[str]:
+        gmail_ids = []
+        for record in history:
+            for change in record.get('messagesAdded', []) + record.get('labelsAdded', []):
+                gmail_ids.append(change['message']['id'])
+        return list(dict.fromkeys(gmail_ids))
+
+    def fetch_emails_full_sync(self, update_existing_records=False) -> int:
+        """Lists every message in the mailbox and resets the history cursor. Returns the number of emails created."""
+        # taken before listing, so changes made during the sync are picked up by the next partial sync
+        history_id = self.gmail_service.users().getProfile(userId='me').execute()['historyId']
         results = self.gmail_service.users().messages().list(userId='me').execute()
         nextPageToken = results.get("nextPageToken")
         messages = results.get('messages', [])
 
-        new_emails = []
-        updated_emails = []
+        num_created = 0
+        num_updated = 0
         while (len(messages) > 0):
             print(f"page size of {len(messages)}")
-            for msg_info in messages:
-                existing_email = Email.query.filter_by(gmail_id=msg_info["id"]).first()
-                if existing_email is not None and not update_existing_records:
-                    continue
-
-                raw_email = self.get_message(msg_info['id'])
-                if existing_email is not None:
-                    existing_email.update_from_raw_gmail(raw_email, self.user_id)
-                    updated_emails.append(existing_email)
-                    continue
-
-                email = Email.from_raw_gmail(raw_email, self.user_id)
-                new_emails.append(email)
+            created, updated = self.sync_messages([msg_info['id'] for msg_info in messages], update_existing_records)
+            num_created += created
+            num_updated += updated
 
             if nextPageToken is None:
                 break
@@ -147,9 +328,28 @@ class GmailClient():
             nextPageToken = results.get("nextPageToken", None)
             messages = results.get('messages', [])
 
-        print(f"Updated {len(updated_emails)} emails")
-        print(f"Created {len(new_emails)} new emails")
-        return new_emails
+        GmailSyncCursor.create_or_update(self.user_id, history_id)
+        print(f"Updated {num_updated} emails")
+        print(f"Created {num_created} new emails")
+        return num_created
+
+    def sync_messages(self, gmail_ids: List[str], update_existing_records: bool) -> Tuple[int, int]:
+        """
+        Creates emails for gmail_ids not in the database yet, and updates the
+        existing ones if update_existing_records. Existing ids are looked up
+        in one query, the messages are fetched in batches and written in one
+        upsert, committed once. Returns (number created, number updated).
+        """
+        existing_gmail_ids = {
+            gmail_id for (gmail_id,) in db_session.query(Email.gmail_id).filter(Email.gmail_id.in_(gmail_ids)).all()
+        }
+        ids_to_fetch = [gmail_id for gmail_id in gmail_ids if update_existing_records or gmail_id not in existing_gmail_ids]
+        if len(ids_to_fetch) == 0:
+            return 0, 0
+        raw_emails = self.get_messages(ids_to_fetch, format=self.sync_format)
+        created, updated = Email.bulk_upsert_from_raw_gmail(list(raw_emails.values()), self.user_id)
+        db_session.commit()
+        return created, updated
 
     def send_message(self, enqueued_message: EnqueuedMessage) -> Dict[str, str]:
         message = MIMEMultipart()
@@ -171,10 +371,12 @@ class GmailClient():
 
     @classmethod
     def authorization_url(cls):
-        return flow.authorization_url()
+        return oauth_flow().authorization_url()
 
     @classmethod
     def credentials_from_oauth_redirect(cls, request_url, user_id):
+        flow = oauth_flow()
         flow.fetch_token(authorization_response=request_url)
         creds = OAuthCredential.create_or_update(user_id, flow.credentials)
+        cls.forget(user_id)
         return creds.to_credentials()
@@ -0,0 +1,37 @@
+from typing import Optional
+from src.models import db, db_session
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, func
+
+
+class GmailSyncCursor(db.Model):
+    """
+    The Gmail historyId a user's mailbox has been synced up to.
+    Incremental syncs ask the history API for changes after it.
+    """
+    __tablename__ = "gmail_sync_cursors"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True)
+    history_id = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=func.now())
+    updated_at = Column(DateTime, nullable=False, default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f'<GmailSyncCursor user_id: {self.user_id} history_id: {self.history_id}>'
+
+    @classmethod
+    def history_id_for(cls, user_id) -> Optional[str]:
+        cursor = db_session.query(cls).filter_by(user_id=user_id).first()
+        return cursor.history_id if cursor else None
+
+    @classmethod
+    def create_or_update(cls, user_id, history_id):
+        cursor = db_session.query(cls).filter_by(user_id=user_id).first()
+        if cursor:
+            cursor.history_id = str(history_id)
+        else:
+            cursor = cls(user_id=user_id, history_id=str(history_id))
+            db_session.add(cursor)
+
+        db_session.commit()
+        return cursor
@@ -4,7 +4,7 @@ from .message_queue import MessageQueue
 
 
 def test_response_listener(email):
-    gmail_client = GmailClient(user_id=1)
+    gmail_client = GmailClient.for_user(1)
     email_content = gmail_client.get_email_content(email)
     print("test_response_listener, email: ", email_content)
 
@@ -0,0 +1,41 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+from decouple import config
+from src.models import db_session, session_scope
+from .gmail_client import GmailClient
+
+
+MAILBOX_SYNC_WORKERS = config('MAILBOX_SYNC_WORKERS', default=4, cast=int)
+
+
+class MailboxSyncResult(NamedTuple):
+    user_id: int
+    num_created: int
+    seconds: float
+    error: Optional[Exception]
+
+
+def sync_user_mailbox(user_id: int) -> MailboxSyncResult:
+    """Syncs one mailbox on the calling thread's own session. Errors are returned rather than raised."""
+    started_at = time.monotonic()
+    try:
+        with session_scope(db_session):
+            num_created = GmailClient.for_user(user_id).sync()
+        return MailboxSyncResult(user_id, num_created, time.monotonic() - started_at, None)
+    except Exception as e:
+        return MailboxSyncResult(user_id, 0, time.monotonic() - started_at, e)
+
+
+def sync_mailboxes(user_ids: List[int], max_workers: int = MAILBOX_SYNC_WORKERS) -> List[MailboxSyncResult]:
+    """Syncs each user's mailbox concurrently, at most max_workers at a time. Results are in the order of user_ids."""
+    if len(user_ids) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(user_ids)), thread_name_prefix="mailbox-sync") as pool:
+        results = list(pool.map(sync_user_mailbox, user_ids))
+    for result in results:
+        if result.error is None:
+            print(f"Synced mailbox of user {result.user_id} in {result.seconds:.1f}s, {result.num_created} new emails")
+        else:
+            print(f"Failed to sync mailbox of user {result.user_id} after {result.seconds:.1f}s: {result.error!r}")
+    return results
@@ -1,7 +1,9 @@
 import math
 import inspect
+from typing import List, Tuple
+import numpy as np
 from src.models import db, db_session
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Float, Integer, String, DateTime, ForeignKey
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from datetime import datetime, timedelta
@@ -11,6 +13,25 @@ from .email import Email
 from .email_event_bus import EmailEventBus
 
 
+ATTENTION_DECAY_HOURS = 6
+ATTENTION_WINDOW_HOURS = 36
+
+
+def waking_hours_before(hours, hour_awake, hour_bedtime):
+    """Number of the whole hours [0, hours), counted from a midnight, whose clock hour is in [hour_awake, hour_bedtime)"""
+    return (hours // 24) * (hour_bedtime - hour_awake) + np.clip(hours % 24, hour_awake, hour_bedtime) - hour_awake
+
+
+def count_waking_hours(start_hour, elapsed_hours, hour_awake, hour_bedtime):
+    """
+    Closed form of stepping an hour at a time from a start at clock hour
+    start_hour until elapsed_hours have passed, counting the steps that land
+    in waking hours. Works elementwise on arrays.
+    """
+    steps = np.floor(elapsed_hours).astype(np.int64) + 1
+    return waking_hours_before(start_hour + steps, hour_awake, hour_bedtime) - waking_hours_before(start_hour, hour_awake, hour_bedtime)
+
+
 class MessageQueue(db.Model):
     __tablename__ = 'message_queues'
 
@@ -21,6 +42,9 @@ class MessageQueue(db.Model):
     created_at = Column(DateTime, default=func.now())
     enqueued_messages = relationship('EnqueuedMessage', back_populates='queue')
     user_attention_bandwidth_minutes = Column(Integer, nullable=False, default=120)
+    # running sum of sent estimated_time, decayed with ATTENTION_DECAY_HOURS, as of decayed_load_updated_at
+    decayed_load_minutes = Column(Float, nullable=False, default=0.0, server_default='0')
+    decayed_load_updated_at = Column(DateTime, nullable=True)
 
     def __repr__(self):
         return f'<MessageQueue {self.name} user_id={self.user_id}>'
@@ -34,13 +58,6 @@ class MessageQueue(db.Model):
             db_session.commit()
         return message_queue
 
-    def send_next_message_if_bandwidth_available(self):
-        remaining_bandwidth = self.user_remaining_attention_bandwidth()
-        print(f"Remaining bandwidth: {remaining_bandwidth}")
-        next_message = self.get_next_message(estimated_time_threshold=remaining_bandwidth)
-        if next_message:
-            self.send_enqueued_message(next_message)
-
     def enqueue_message(self, content, recipient_email, parent_message_id=None, subject=None, estimated_time=None, response_listener=None):
         if parent_message_id is None and subject is None:
             raise ValueError("parent_message_id or subject must be provided")
@@ -75,56 +92,76 @@ class MessageQueue(db.Model):
         db_session.commit()
         return message
 
-    def user_remaining_attention_bandwidth(self):
+    @classmethod
+    def user_is_awake(cls, user, now: datetime) -> bool:
+        hour_awake = user.hour_awake or 9
+        hour_bedtime = user.hour_bedtime or 17
+        return hour_awake <= now.hour < hour_bedtime
+
+    def current_decayed_load(self, now: datetime) -> float:
+        """
+        The decayed minutes of attention already asked of the user, read from
+        the running value in O(1). The first call seeds it from history; the
+        seed is flushed and saved with the caller's commit.
+        """
+        if self.decayed_load_updated_at is None:
+            self.decayed_load_minutes = self.decayed_load_from_history(now)
+            self.decayed_load_updated_at = now
+            db_session.flush()
+        hours_since_update = max(0.0, (now - self.decayed_load_updated_at).total_seconds() / 3600)
+        return self.decayed_load_minutes * math.exp(-hours_since_update / ATTENTION_DECAY_HOURS)
+
+    def add_sent_load(self, estimated_time: float, sent_at: datetime):
+        """Adds a sent message to the running decayed load. Committed by the caller."""
+        self.decayed_load_minutes = self.current_decayed_load(sent_at) + estimated_time
+        self.decayed_load_updated_at = sent_at
+
+    def decayed_load_from_history(self, now: datetime) -> float:
+        """
+        Sums the decayed, waking-hours weighted time of the messages sent in
+        the last ATTENTION_WINDOW_HOURS. Only used to seed the running value.
+        """
         hour_awake = self.user.hour_awake or 9
         hour_bedtime = self.user.hour_bedtime or 17
-        now = datetime.now()
-        if now.hour < hour_awake or now.hour >= hour_bedtime:
-            return 0
-
-        thirty_six_hours_ago = now - timedelta(hours=36)
-
-        sent_messages = EnqueuedMessage.query.filter(
+        rows = db_session.query(EnqueuedMessage.sent_at, EnqueuedMessage.estimated_time).filter(
             EnqueuedMessage.queue_id == self.id,
-            EnqueuedMessage.sent_at >= thirty_six_hours_ago,
+            EnqueuedMessage.sent_at >= now - timedelta(hours=ATTENTION_WINDOW_HOURS),
             EnqueuedMessage.sent_at <= now
         ).all()
+        if len(rows) == 0:
+            return 0.0
 
-        total_weighted_time = 0
-        for message in sent_messages:
-            weighted_time = self._calculate_weighted_time(message, now, hour_awake, hour_bedtime)
-            total_weighted_time += weighted_time
+        sent_at = np.array([row[0] for row in rows], dtype='datetime64[us]')
+        estimated_time = np.array([row[1] for row in rows], dtype=np.float64)
+        hours_since_sent = (np.datetime64(now, 'us') - sent_at) / np.timedelta64(1, 'h')
+        waking_hours = count_waking_hours(np.array([row[0].hour for row in rows]), hours_since_sent, hour_awake, hour_bedtime)
+        waking_ratio = np.divide(waking_hours, hours_since_sent, out=np.ones_like(hours_since_sent), where=hours_since_sent > 0)
+        return float(np.sum(estimated_time * np.exp(-hours_since_sent / ATTENTION_DECAY_HOURS) * waking_ratio))
 
-        remaining_bandwidth = self.user_attention_bandwidth_minutes - total_weighted_time
-
-        return max(0, remaining_bandwidth)
-
-    def _calculate_weighted_time(self, message, now, hour_awake, hour_bedtime):
-        hours_since_sent = (now - message.sent_at).total_seconds() / 3600
-        decay_factor = math.exp(-hours_since_sent / 6)  # Half-life of 6 hours
-
-        # Calculate the number of waking hours since the message was sent
-        waking_hours = self._count_waking_hours(message.sent_at, now, hour_awake, hour_bedtime)
-
-        return message.estimated_time * decay_factor * (waking_hours / hours_since_sent)
-
-    def _count_waking_hours(self, start, end, hour_awake, hour_bedtime):
-        waking_hours = 0
-        current = start
-        while current <= end:
-            if current.hour >= hour_awake and current.hour < hour_bedtime:
-                waking_hours += 1
-            current += timedelta(hours=1)
-        return waking_hours
-
-    def send_enqueued_message(self, enqueued_message):
-        gmail_response = GmailClient(user_id=self.user_id).send_message(enqueued_message)
-        thread_id = gmail_response['threadId']
-        EmailEventBus.register_listener(thread_id, enqueued_message.response_listener)
-        enqueued_message.mark_as_sent(thread_id)
+    @classmethod
+    def send_batch(cls, user_id: int, queued_messages: List[Tuple["MessageQueue", EnqueuedMessage]]) -> int:
+        """
+        Sends (queue, enqueued message) pairs of one user through that user's
+        cached Gmail client, then records every listener, queue load and
+        sent_at in a single commit. If a send fails, the messages sent before
+        it are still recorded before the error is raised. Returns the number sent.
+        """
+        gmail_client = GmailClient.for_user(user_id)
+        sent = []
+        try:
+            for queue, enqueued_message in queued_messages:
+                gmail_response = gmail_client.send_message(enqueued_message)
+                sent.append((queue, enqueued_message, gmail_response['threadId'], datetime.now()))
+        finally:
+            cls.record_sent(sent)
+        return len(sent)
 
-    def get_next_message(self, estimated_time_threshold=None):
-        query = db_session.query(EnqueuedMessage).filter(EnqueuedMessage.queue_id == self.id, EnqueuedMessage.sent_at == None)
-        if estimated_time_threshold is not None:
-            query = query.filter(EnqueuedMessage.estimated_time <= estimated_time_threshold)
-        return query.order_by(EnqueuedMessage.created_at).first()
+    @classmethod
+    def record_sent(cls, sent: List[Tuple["MessageQueue", EnqueuedMessage, str, datetime]]):
+        if len(sent) == 0:
+            return
+        EmailEventBus.register_listeners([(thread_id, enqueued_message.response_listener) for _, enqueued_message, thread_id, _ in sent])
+        for queue, enqueued_message, thread_id, sent_at in sent:
+            queue.add_sent_load(enqueued_message.estimated_time, sent_at)
+            enqueued_message.mark_as_sent(thread_id, sent_at)
+        db_session.commit()
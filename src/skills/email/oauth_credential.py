@@ -32,8 +32,9 @@ class OAuthCredential(db.Model):
         return True
 
     @classmethod
-    def create_or_update(cls, user_id, credentials):
-        credential = cls.query.filter_by(user_id=user_id).first()
+    def create_or_update(cls, user_id, credentials, session=None):
+        session = session or db_session
+        credential = session.query(cls).filter_by(user_id=user_id).first()
         if credential:
             credential.token = credentials.token
             credential.refresh_token = credentials.refresh_token
@@ -53,11 +54,23 @@ class OAuthCredential(db.Model):
                 scopes=json.dumps(credentials.scopes),
                 expiry=credentials.expiry
             )
-            db_session.add(credential)
+            session.add(credential)
 
-        db_session.commit()
+        session.commit()
         return credential
 
+    @classmethod
+    def store_refreshed_credentials(cls, user_id, credentials):
+        """
+        Saves a refreshed token in a short session of its own. A refresh can
+        happen in the middle of a caller's unit of work, which must not be committed with it.
+        """
+        session = db_session.session_factory()
+        try:
+            cls.create_or_update(user_id, credentials, session)
+        finally:
+            session.close()
+
     def to_credentials(self):
         return Credentials(
             token=self.token,
@@ -65,5 +78,6 @@ class OAuthCredential(db.Model):
             token_uri=self.token_uri,
             client_id=self.client_id,
             client_secret=self.client_secret,
-            scopes=json.loads(self.scopes) if self.scopes else None
+            scopes=json.loads(self.scopes) if self.scopes else None,
+            expiry=self.expiry
         )
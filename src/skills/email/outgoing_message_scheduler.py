@@ -0,0 +1,95 @@
+import heapq
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy.orm import joinedload
+from src.models import db_session
+from .enqueued_message import EnqueuedMessage
+from .message_queue import MessageQueue
+
+
+class OutgoingMessageScheduler:
+    """
+    Sends enqueued messages for every user in one pass.
+
+    A user's queues share one attention budget: the smallest
+    user_attention_bandwidth_minutes of their queues, minus the decayed load
+    of all of them. Pending messages from all the user's queues are taken
+    oldest first (shorter first on ties) from a heap, and every message that
+    still fits the remaining budget is sent in one batch per user.
+    """
+    def run(self, now: Optional[datetime] = None) -> int:
+        """Returns the number of messages sent"""
+        now = now or datetime.now()
+        queues = db_session.query(MessageQueue)\
+            .options(joinedload(MessageQueue.user))\
+            .order_by(MessageQueue.user_id, MessageQueue.id)\
+            .all()
+        queues_by_user: Dict[int, List[MessageQueue]] = defaultdict(list)
+        for queue in queues:
+            queues_by_user[queue.user_id].append(queue)
+        budgets = {}
+        for user_id, user_queues in queues_by_user.items():
+            try:
+                budgets[user_id] = self.remaining_budget(user_queues, now)
+            except Exception as e:
+                db_session.rollback()
+                budgets[user_id] = 0.0
+                print(f"Failed to compute the remaining bandwidth of user {user_id}: {e!r}")
+            print(f"Remaining bandwidth for user {user_id}: {budgets[user_id]}")
+        # keeps load values seeded while computing the budgets
+        db_session.commit()
+        pending_by_queue = self.pending_messages_by_queue(
+            {queue.id: budgets[queue.user_id] for queue in queues if budgets[queue.user_id] > 0}
+        )
+
+        num_sent = 0
+        for user_id, user_queues in queues_by_user.items():
+            if budgets[user_id] <= 0:
+                continue
+            try:
+                num_sent += self.schedule_user(user_queues, pending_by_queue, budgets[user_id])
+            except Exception as e:
+                db_session.rollback()
+                print(f"Failed to send messages for user {user_id}: {e!r}")
+        return num_sent
+
+    # the oldest fitting messages of a queue are considered first, the rest wait for a later tick
+    candidates_per_queue = 20
+
+    def pending_messages_by_queue(self, budget_by_queue: Dict[int, float]) -> Dict[int, List[EnqueuedMessage]]:
+        pending_by_queue = defaultdict(list)
+        for message in EnqueuedMessage.pending_for_queues(budget_by_queue, self.candidates_per_queue):
+            pending_by_queue[message.queue_id].append(message)
+        return pending_by_queue
+
+    @classmethod
+    def remaining_budget(cls, queues: List[MessageQueue], now: datetime) -> float:
+        if not MessageQueue.user_is_awake(queues[0].user, now):
+            return 0.0
+        budget = min(queue.user_attention_bandwidth_minutes for queue in queues)
+        load = sum(queue.current_decayed_load(now) for queue in queues)
+        return max(0.0, budget - load)
+
+    def schedule_user(self, queues: List[MessageQueue], pending_by_queue: Dict[int, List[EnqueuedMessage]], remaining: float) -> int:
+        """Sends the pending messages of one user's queues that fit in remaining minutes"""
+        if remaining <= 0:
+            return 0
+        queues_by_id = {queue.id: queue for queue in queues}
+        heap = [
+            (message.created_at or datetime.min, message.estimated_time, message.id, message)
+            for queue in queues
+            for message in pending_by_queue.get(queue.id, [])
+        ]
+        heapq.heapify(heap)
+
+        batch = []
+        while heap and remaining > 0:
+            _created_at, estimated_time, _id, message = heapq.heappop(heap)
+            if estimated_time > remaining:
+                continue
+            batch.append((queues_by_id[message.queue_id], message))
+            remaining -= estimated_time
+        if len(batch) == 0:
+            return 0
+        return MessageQueue.send_batch(queues[0].user_id, batch)
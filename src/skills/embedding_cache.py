@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+from typing import Dict, Sequence, Tuple
+import numpy as np
+from decouple import config
+
+
+EMBEDDING_CACHE_PATH = config('EMBEDDING_CACHE_PATH', default="./embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = config('EMBEDDING_CACHE_MAX_ENTRIES', default=200_000, cast=int)
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by (model name, instruction, sha256 of text).
+
+    Backed by a local sqlite file so it survives restarts and can be shared by
+    several processes on the same machine. Once it holds more than
+    `max_entries` vectors the least recently used ones are evicted.
+
+    Reads do not write: last_used_at touches are kept in memory and applied
+    with the next put, or once `max_pending_touches` have built up. The row
+    count is tracked from this process's inserts and only recounted when it
+    may be over the limit, or every `recount_every` puts to pick up other
+    processes' inserts.
+    """
+    max_pending_touches = 1000
+    recount_every = 100
+
+    def __init__(self, path: str, max_entries: int) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._connection = None
+        self._lock = threading.Lock()
+        self._pending_touches: Dict[Tuple[str, str, str], float] = {}
+        self._approximate_count = 0
+        self._puts_since_recount = 0
+
+    @classmethod
+    def content_sha(cls, text: str) -> str:
+        return sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, model_name: str, instruction: str, texts: Sequence[str]) -> Dict[int, np.ndarray]:
+        """Returns {index into texts: vector} for every text already in the cache"""
+        if len(texts) == 0:
+            return {}
+        shas = [self.content_sha(text) for text in texts]
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            unique_shas = list(set(shas))
+            for start in range(0, len(unique_shas), 500):
+                chunk = unique_shas[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT content_sha, vector FROM embeddings WHERE model_name = ? AND instruction = ? "
+                    f"AND content_sha IN ({','.join('?' * len(chunk))})",
+                    [model_name, instruction, *chunk],
+                ).fetchall()
+                found.update({sha: np.frombuffer(vector, dtype=np.float32) for sha, vector in rows})
+            now = time.time()
+            for sha in found:
+                self._pending_touches[(model_name, instruction, sha)] = now
+            if len(self._pending_touches) >= self.max_pending_touches:
+                self._apply_touches(connection)
+                connection.commit()
+        return {i: found[sha] for i, sha in enumerate(shas) if sha in found}
+
+    def put_many(self, model_name: str, instruction: str, texts: Sequence[str], vectors: np.ndarray):
+        now = time.time()
+        rows = [
+            (model_name, instruction, self.content_sha(text), np.asarray(vec, dtype=np.float32).tobytes(), now)
+            for text, vec in zip(texts, vectors)
+        ]
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model_name, instruction, content_sha, vector, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._apply_touches(connection)
+            # replaced rows are counted again, so this only ever overestimates
+            self._approximate_count += len(rows)
+            self._puts_since_recount += 1
+            self._evict(connection)
+            connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count(self._connect())
+
+    def _apply_touches(self, connection):
+        if not self._pending_touches:
+            return
+        connection.executemany(
+            "UPDATE embeddings SET last_used_at = ? WHERE model_name = ? AND instruction = ? AND content_sha = ?",
+            [(used_at, *key) for key, used_at in self._pending_touches.items()],
+        )
+        self._pending_touches.clear()
+
+    def _count(self, connection) -> int:
+        self._approximate_count = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self._puts_since_recount = 0
+        return self._approximate_count
+
+    def _evict(self, connection):
+        if self._approximate_count <= self.max_entries and self._puts_since_recount < self.recount_every:
+            return
+        overflow = self._count(connection) - self.max_entries
+        if overflow <= 0:
+            return
+        connection.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_used_at ASC LIMIT ?)",
+            (overflow,),
+        )
+        self._approximate_count = self.max_entries
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model_name TEXT NOT NULL,
+                    instruction TEXT NOT NULL,
+                    content_sha TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    PRIMARY KEY (model_name, instruction, content_sha)
+                )
+            """)
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_embeddings_last_used_at ON embeddings (last_used_at)"
+            )
+            self._connection.commit()
+            self._count(self._connection)
+        return self._connection
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)
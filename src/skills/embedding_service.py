@@ -0,0 +1,97 @@
+import threading
+import weakref
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.skills.base import DEFAULT_EMBEDDINGS_MODEL_NAME, default_embeddings_model
+from src.skills.embedding_cache import embedding_cache
+from src.skills.embedding_worker import embedding_worker_client
+
+
+class EmbeddingService:
+    """
+    Shared entry point for INSTRUCTOR encodes.
+
+    Texts already in the embedding cache cost no forward pass. The rest are
+    sent to the embedding worker when EMBEDDING_WORKER_ADDRESS is set, or
+    else encoded in-process, in size-bounded batches sorted by length so
+    each forward pass pads to a similar sequence length. ORM objects can
+    defer their encode with `embed_on_flush`; every object waiting in a
+    session gets its vector in bulk right before that session flushes.
+    """
+    batch_size = 32
+    _local = threading.local()
+
+    @classmethod
+    def encode(cls, instruction: str, texts: Sequence[str]) -> np.ndarray:
+        """Returns a (len(texts), dim) array, rows in the same order as texts"""
+        if len(texts) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        vectors = embedding_cache.get_many(DEFAULT_EMBEDDINGS_MODEL_NAME, instruction, texts)
+        missing_texts = list(dict.fromkeys(text for i, text in enumerate(texts) if i not in vectors))
+        if missing_texts:
+            encoded = cls._encode_missing(instruction, missing_texts)
+            embedding_cache.put_many(DEFAULT_EMBEDDINGS_MODEL_NAME, instruction, missing_texts, encoded)
+            encoded_by_text = dict(zip(missing_texts, encoded))
+            for i, text in enumerate(texts):
+                if i not in vectors:
+                    vectors[i] = encoded_by_text[text]
+        return np.asarray([vectors[i] for i in range(len(texts))], dtype=np.float32)
+
+    @classmethod
+    def _encode_missing(cls, instruction: str, texts: Sequence[str]) -> np.ndarray:
+        if embedding_worker_client is not None:
+            return embedding_worker_client.encode(instruction, texts)
+        return cls._encode_batches(instruction, texts)
+
+    @classmethod
+    def _encode_batches(cls, instruction: str, texts: Sequence[str]) -> np.ndarray:
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), cls.batch_size):
+            batch_indices = order[start:start + cls.batch_size]
+            encoded = default_embeddings_model.encode(
+                [[instruction, texts[i]] for i in batch_indices],
+                batch_size=len(batch_indices),
+            )
+            for i, vec in zip(batch_indices, encoded):
+                vectors[i] = vec
+        return np.asarray(vectors, dtype=np.float32)
+
+    @classmethod
+    def encode_one(cls, instruction: str, text: str) -> List[float]:
+        return cls.encode(instruction, [text])[0].tolist()
+
+    @classmethod
+    def embed_on_flush(cls, target, attribute: str, instruction: str, text: str):
+        """Sets `target.<attribute>` to the embedding of text when its session next flushes"""
+        cls._pending()[target] = (attribute, instruction, text)
+
+    @classmethod
+    def embed_pending(cls, session: Session):
+        pending = cls._pending()
+        by_instruction: Dict[str, List[Tuple[object, str, str]]] = {}
+        for target, (attribute, instruction, text) in list(pending.items()):
+            if target not in session:
+                continue
+            by_instruction.setdefault(instruction, []).append((target, attribute, text))
+            del pending[target]
+
+        for instruction, items in by_instruction.items():
+            vectors = cls.encode(instruction, [text for _, _, text in items])
+            for (target, attribute, _), vec in zip(items, vectors):
+                setattr(target, attribute, vec)
+
+    @classmethod
+    def _pending(cls) -> "weakref.WeakKeyDictionary":
+        # sessions are thread-local, so pending encodes are too
+        if not hasattr(cls._local, "pending"):
+            cls._local.pending = weakref.WeakKeyDictionary()
+        return cls._local.pending
+
+
+def on_before_flush(session, _flush_context, _instances):
+    EmbeddingService.embed_pending(session)
+
+event.listen(Session, 'before_flush', on_before_flush)
@@ -0,0 +1,129 @@
+import threading
+from multiprocessing.connection import Client, Listener
+from typing import Sequence
+import numpy as np
+from decouple import config
+
+
+# e.g. "localhost:6010" or a unix socket path. When unset, embeddings are computed in-process.
+EMBEDDING_WORKER_ADDRESS = config('EMBEDDING_WORKER_ADDRESS', default=None)
+# shared secret for the socket. Both sides unpickle what they receive, so there is no default.
+EMBEDDING_WORKER_AUTHKEY = config('EMBEDDING_WORKER_AUTHKEY', default=None)
+
+
+def parse_address(address: str):
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+
+def require_authkey(authkey) -> bytes:
+    authkey = authkey or EMBEDDING_WORKER_AUTHKEY
+    if not authkey:
+        raise ValueError("EMBEDDING_WORKER_AUTHKEY must be set to use the embedding worker")
+    return authkey.encode('utf-8') if isinstance(authkey, str) else authkey
+
+
+class EmbeddingWorker:
+    """
+    Standalone process that owns the INSTRUCTOR model.
+
+    Web and scheduler processes send it batched encode requests over a local
+    socket, so they all share one copy of the model and embedding work never
+    runs on their request or job threads. Run with:
+
+        python -m src.skills.embedding_worker
+    """
+    def __init__(self, address: str, authkey=None) -> None:
+        self.address = parse_address(address)
+        self.authkey = require_authkey(authkey)
+        self._encode_lock = threading.Lock()
+
+    def serve_forever(self):
+        from src.skills.model_registry import ModelRegistry
+        ModelRegistry.warm()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Embedding worker listening on {self.address}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    print("Rejected embedding worker connection: ", e)
+                    continue
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+    def handle_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    return
+                connection.send(self.handle_request(request))
+
+    def handle_request(self, request):
+        # imported here, embedding_service imports this module for the client
+        from src.skills.embedding_service import EmbeddingService
+        command, *args = request
+        try:
+            if command == "ping":
+                return ("ok", None)
+            if command == "encode":
+                instruction, texts = args
+                # one forward pass at a time, torch already uses every core
+                with self._encode_lock:
+                    return ("ok", EmbeddingService._encode_batches(instruction, texts))
+            return ("error", f"unknown command {command}")
+        except Exception as e:
+            return ("error", f"{type(e).__name__}: {e}")
+
+
+class EmbeddingWorkerClient:
+    """Sends encode requests to an EmbeddingWorker, one connection per thread"""
+    def __init__(self, address: str, authkey=None) -> None:
+        self.address = parse_address(address)
+        self.authkey = require_authkey(authkey)
+        self._local = threading.local()
+
+    def encode(self, instruction: str, texts: Sequence[str]) -> np.ndarray:
+        return self._request(("encode", instruction, list(texts)))
+
+    def ping(self) -> bool:
+        self._request(("ping",))
+        return True
+
+    def _request(self, request):
+        try:
+            status, result = self._send(request)
+        except (EOFError, OSError):
+            # the worker may have restarted since this thread last connected
+            self._disconnect()
+            status, result = self._send(request)
+        if status != "ok":
+            raise RuntimeError(f"Embedding worker error: {result}")
+        return result
+
+    def _send(self, request):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = Client(self.address, authkey=self.authkey)
+            self._local.connection = connection
+        connection.send(request)
+        return connection.recv()
+
+    def _disconnect(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+
+embedding_worker_client = EmbeddingWorkerClient(EMBEDDING_WORKER_ADDRESS) if EMBEDDING_WORKER_ADDRESS else None
+
+
+if __name__ == '__main__':
+    EmbeddingWorker(EMBEDDING_WORKER_ADDRESS or "localhost:6010").serve_forever()
@@ -3,7 +3,7 @@ from typing import List
 from decouple import config
 from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey, func, Index, event
 from sqlalchemy.orm import relationship
-from src.skills.base import default_embeddings_model
+from src.skills.embedding_service import EmbeddingService
 from src.models import db, Vector, db_session
 from src.skills.email.message_queue import MessageQueue
 import anthropic
@@ -14,10 +14,10 @@ from src.log_chat_messages import log_chat_messages
 
 BOT_EMAIL_ADDRESS = config('EMAIL_ADDRESS')
 
+OPEN_QUESTION_EMBEDDING_INSTRUCTION = "Represent an open question or problem that the user is interested in: "
+
 def instructor_note_embed(doc_string):
-    instruction = "Represent an open question or problem that the user is interested in: "
-    vec = default_embeddings_model.encode([[instruction, doc_string]]).tolist()
-    return vec[0]
+    return EmbeddingService.encode_one(OPEN_QUESTION_EMBEDDING_INSTRUCTION, doc_string)
 
 class OpenQuestion(db.Model):
     __tablename__ = "open_questions"
@@ -86,7 +86,7 @@ class OpenQuestion(db.Model):
         db_session.commit()
 
 def on_change_content(target, value, _oldvalue, _initiator):
-    target.instructor_base_embedding = instructor_note_embed(value)
+    EmbeddingService.embed_on_flush(target, 'instructor_base_embedding', OPEN_QUESTION_EMBEDDING_INSTRUCTION, value)
 
 event.listen(OpenQuestion.content, 'set', on_change_content)
 
@@ -121,7 +121,7 @@ def handle_open_question_user_response(email):
     )
     user_id = 1
 
-    gmail_client = GmailClient(user_id=user_id)
+    gmail_client = GmailClient.for_user(user_id)
     email_content = gmail_client.get_email_content(email)
     zettels = ["# "+ztl.title+"\n\n"+ztl.content for ztl, _ in Zettel.find_similar(email_content, limit=20)]
     thread_chat = gmail_client.thread_as_chat_history(email.thread_id)
@@ -0,0 +1,77 @@
+import threading
+from decouple import config
+
+
+DEFAULT_EMBEDDINGS_MODEL_NAME = 'hkunlp/instructor-base'
+documents_collection_path = config('DOCUMENTS_COLLECTION_PATH', default="./documents_collection")
+
+
+class ModelRegistry:
+    """
+    Loads the INSTRUCTOR models and the Chroma client on first use.
+
+    Importing torch and loading the model costs seconds and hundreds of MB, so
+    processes that never embed (mailbox sync, the send queue) never pay for it.
+    Call `warm` to load up front instead.
+    """
+    _lock = threading.Lock()
+    _embeddings_models = {}
+    _chroma_client = None
+
+    @classmethod
+    def embeddings_model(cls, model_name: str = DEFAULT_EMBEDDINGS_MODEL_NAME):
+        if model_name not in cls._embeddings_models:
+            with cls._lock:
+                if model_name not in cls._embeddings_models:
+                    from InstructorEmbedding import INSTRUCTOR
+                    print(f"Loading embeddings model {model_name}")
+                    cls._embeddings_models[model_name] = INSTRUCTOR(model_name)
+        return cls._embeddings_models[model_name]
+
+    @classmethod
+    def chroma_client(cls):
+        if cls._chroma_client is None:
+            with cls._lock:
+                if cls._chroma_client is None:
+                    import chromadb
+                    cls._chroma_client = chromadb.PersistentClient(path=documents_collection_path)
+        return cls._chroma_client
+
+    @classmethod
+    def is_loaded(cls, model_name: str = DEFAULT_EMBEDDINGS_MODEL_NAME) -> bool:
+        return model_name in cls._embeddings_models
+
+    @classmethod
+    def warm(cls, model_name: str = DEFAULT_EMBEDDINGS_MODEL_NAME, chroma: bool = False):
+        cls.embeddings_model(model_name)
+        if chroma:
+            cls.chroma_client()
+
+
+class LazyProxy:
+    """Stands in for the object returned by `factory`, creating it on first attribute access"""
+    def __init__(self, factory) -> None:
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_instance', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _resolve(self):
+        if self._instance is None:
+            # threads racing on the first access share one instance
+            with self._lock:
+                if self._instance is None:
+                    object.__setattr__(self, '_instance', self._factory())
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+
+def lazy_collection(name: str, embedding_function) -> LazyProxy:
+    return LazyProxy(lambda: ModelRegistry.chroma_client().get_or_create_collection(
+        name=name,
+        embedding_function=embedding_function
+    ))
@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+
+
+class ClusteringResult(NamedTuple):
+    num_clusters: int
+    labels: np.ndarray
+    centroids: np.ndarray
+    score: float
+
+
+# set once per pool worker by _init_worker, so the matrix is pickled once per process rather than once per k
+_worker_embeddings = None
+
+
+def _init_worker(embeddings: np.ndarray, threads_per_worker: int):
+    global _worker_embeddings
+    from threadpoolctl import threadpool_limits
+    # KMeans is itself multithreaded; keep the pool from oversubscribing the cores
+    threadpool_limits(limits=threads_per_worker)
+    _worker_embeddings = embeddings
+
+
+def _fit_in_worker(num_clusters: int, silhouette_sample_size: Optional[int]) -> ClusteringResult:
+    return fit_kmeans(_worker_embeddings, num_clusters, silhouette_sample_size)
+
+
+def fit_kmeans(embeddings: np.ndarray, num_clusters: int, silhouette_sample_size: Optional[int] = None) -> ClusteringResult:
+    """Fits KMeans and scores it by silhouette, computed on a random sample of silhouette_sample_size rows if given"""
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    kmeans = KMeans(n_clusters=num_clusters, random_state=42)
+    labels = kmeans.fit_predict(embeddings)
+    score = silhouette_score(embeddings, labels, sample_size=silhouette_sample_size, random_state=42)
+    return ClusteringResult(num_clusters, labels, kmeans.cluster_centers_, float(score))
+
+
+class ClusterCountSelector:
+    """
+    Picks the number of clusters with the best silhouette score.
+
+    Candidate k values are fit in parallel in a process pool, and every
+    fitted result is kept so the winner never has to be refit. Above
+    `silhouette_sample_size` rows the O(N²) silhouette is estimated on a
+    random sample of that many rows.
+    """
+    def __init__(self, max_workers: Optional[int] = None, silhouette_sample_size: int = 2000, min_rows_for_pool: int = 500) -> None:
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.silhouette_sample_size = silhouette_sample_size
+        self.min_rows_for_pool = min_rows_for_pool
+
+    def search(self, embeddings: np.ndarray, min_clusters: int, max_clusters: int) -> Tuple[ClusteringResult, List[ClusteringResult]]:
+        """Returns (best result, results for every candidate k in ascending order)"""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        num_rows = embeddings.shape[0]
+        # silhouette is only defined for 2 <= k <= N - 1
+        candidates = [k for k in range(max(2, min_clusters), max_clusters + 1) if k < num_rows]
+        if len(candidates) == 0:
+            raise ValueError(f"No valid cluster counts between {min_clusters} and {max_clusters} for {num_rows} embeddings")
+        sample_size = self.silhouette_sample_size if num_rows > self.silhouette_sample_size else None
+
+        workers = min(self.max_workers, len(candidates))
+        if workers <= 1 or num_rows < self.min_rows_for_pool:
+            results = [fit_kmeans(embeddings, k, sample_size) for k in candidates]
+        else:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+            # never fork the multithreaded web/scheduler process, a child could inherit a lock held by another thread
+            mp_context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker, initargs=(embeddings, threads_per_worker)) as pool:
+                results = list(pool.map(_fit_in_worker, candidates, [sample_size] * len(candidates)))
+
+        for result in results:
+            print(f"{result.num_clusters} clusters: silhouette score {result.score:.4f}")
+        best = max(results, key=lambda result: result.score)
+        return best, results
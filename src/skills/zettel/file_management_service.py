@@ -1,6 +1,8 @@
 import os
 from tqdm import tqdm
 from .zettel import Zettel
+from .zettel_topic_association import ZettelTopicAssociation
+from src.skills.embedding_service import EmbeddingService
 from src.models import db_session
 
 
@@ -17,6 +19,10 @@ class FileManagementService:
         self.itemCount = 0
         self.zettelsWithoutFileDeleted = 0
         self.allShasInFiles = set()
+        # consumed by TopicMaintenanceService to update topics incrementally
+        self.changedZettels = []
+        self.changedZettelIds = set()
+        self.removedTopicMemberships = []
 
     def sync_documents_from_folder(self, folderPath, user):
         self.add_documents_from_folder(folderPath, user)
@@ -28,6 +34,8 @@ class FileManagementService:
         print(f"{len(allDocs)} synced docs in db")
         items = os.listdir(folderPath)
         self.itemCount = len(items)
+        # Zettels are committed in batches so their embeddings are encoded together at flush
+        self.uncommittedZettels = []
         for item in tqdm(items, desc="Processing files"):
             if item.startswith('.'):
                 self.numSkippedInvalidItems += 1
@@ -45,9 +53,7 @@ class FileManagementService:
                 fileContentSha = Zettel.doc_sha(filtered_data)
                 self.allShasInFiles.add(fileContentSha)
                 title = item.removesuffix('.md')
-                existingZettels = db_session.query(Zettel).filter(
-                    (Zettel.sha == fileContentSha) | (Zettel.filepath == item_path)
-                ).all()
+                existingZettels = self.find_existing_zettels(fileContentSha, item_path)
                 if len(existingZettels) == 0:
                     # create
                     newZettel = Zettel(
@@ -58,45 +64,95 @@ class FileManagementService:
                     )
                     self.numDocsMade += 1
                     db_session.add(newZettel)
-                    db_session.commit()
+                    self.changedZettels.append(newZettel)
+                    self.add_uncommitted_zettel(newZettel)
                     continue
                 if len(existingZettels) > 1:
                     print('found multiple docs, deleting duplicates: ', [z.id for z in existingZettels[1:]])
                     # Delete duplicates
                     duplicates = existingZettels[1:]
                     for dup in duplicates:
-                        db_session.delete(dup)
-                    db_session.commit()
+                        self.remove_duplicate_zettel(dup)
                     self.numFilesDeleted += len(duplicates)
                 if len(existingZettels) > 0:
                     # repair
                     upsert_needed = False
                     ztl = existingZettels[0]
                     if ztl.content != filtered_data:
+                        # the embedding still holds the old content until the next flush
+                        self.record_removed_topic_memberships([ztl])
+                        if ztl not in self.changedZettels:
+                            self.changedZettels.append(ztl)
                         ztl.content = filtered_data
-                        db_session.add(ztl)
-                        db_session.commit()
                         upsert_needed = True
                     if ztl.title != title:
                         ztl.title = title
-                        db_session.add(ztl)
-                        db_session.commit()
                         upsert_needed = True
                     if ztl.filepath != item_path:
                         upsert_needed = True
                         ztl.filepath = item_path
-                        db_session.add(ztl)
-                        db_session.commit()
                     if upsert_needed:
                         print("Repairing: ", [ztl.id for ztl in existingZettels])
                         self.numFilesMetadataUpdated += 1
+                        db_session.add(ztl)
+                        self.add_uncommitted_zettel(ztl)
                     else:
                         self.numExistingFilesSkipped += 1
                     continue
+        self.commit_batch()
+
+    def find_existing_zettels(self, sha, filepath):
+        uncommitted = [
+            ztl for ztl in self.uncommittedZettels
+            if ztl.sha == sha or ztl.filepath == filepath
+        ]
+        # no autoflush, otherwise every lookup would flush (and embed) the pending batch
+        with db_session.no_autoflush:
+            existing = db_session.query(Zettel).filter(
+                (Zettel.sha == sha) | (Zettel.filepath == filepath)
+            ).all()
+        return uncommitted + [ztl for ztl in existing if ztl not in uncommitted]
+
+    def add_uncommitted_zettel(self, ztl):
+        if ztl not in self.uncommittedZettels:
+            self.uncommittedZettels.append(ztl)
+        if len(self.uncommittedZettels) >= EmbeddingService.batch_size:
+            self.commit_batch()
+
+    def commit_batch(self):
+        db_session.flush()
+        # ids are read while the batch is still loaded, the commit expires it and each id would cost a SELECT
+        self.changedZettelIds.update(ztl.id for ztl in self.uncommittedZettels if ztl in self.changedZettels)
+        db_session.commit()
+        self.uncommittedZettels = []
+
+    def remove_duplicate_zettel(self, ztl):
+        if ztl in self.uncommittedZettels:
+            self.uncommittedZettels.remove(ztl)
+        if ztl in self.changedZettels:
+            self.changedZettels.remove(ztl)
+        self.changedZettelIds.discard(ztl.id)
+        if ztl in db_session.new:
+            db_session.expunge(ztl)
+        else:
+            self.record_removed_topic_memberships([ztl])
+            db_session.delete(ztl)
+
+    def record_removed_topic_memberships(self, zettels):
+        """Records (topic id, embedding) for every topic the zettels currently belong to"""
+        embeddings = {ztl.id: ztl.instructor_base_embedding for ztl in zettels if ztl.id is not None and ztl.instructor_base_embedding is not None}
+        if len(embeddings) == 0:
+            return
+        with db_session.no_autoflush:
+            associations = db_session.query(ZettelTopicAssociation.zettel_id, ZettelTopicAssociation.topic_id)\
+                .filter(ZettelTopicAssociation.zettel_id.in_(list(embeddings)))\
+                .all()
+        self.removedTopicMemberships.extend((topic_id, embeddings[zettel_id]) for zettel_id, topic_id in associations)
 
     def delete_documents_missing_from_folder(self):
         zettelsToDelete = db_session.query(Zettel).filter(~Zettel.sha.in_(self.allShasInFiles)).all()
         self.zettelsWithoutFileDeleted = len(zettelsToDelete)
+        self.record_removed_topic_memberships(zettelsToDelete)
         for ztl in tqdm(zettelsToDelete, desc="Deleting docs without files"):
             print("deleting Zettel: ", ztl)
             db_session.delete(ztl)
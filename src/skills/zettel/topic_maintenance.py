@@ -0,0 +1,236 @@
+from typing import Iterable, List, Tuple
+import numpy as np
+from sqlalchemy import select, update
+from src.models import db_session, load_vector_matrix, normalize_rows
+from .zettel import Zettel
+from .zettel_topic_association import ZettelTopicAssociation
+from .zettelkasten_topic import ZettelkastenTopic
+from .cluster_selection import fit_kmeans
+from .topic_summarizer import TopicSummarizer, ZettelText
+
+
+class TopicMaintenanceService:
+    """
+    Keeps a user's topics current as zettels change, without re-clustering.
+
+    Changed and new zettels are assigned to their nearest topic centroid,
+    and centroids are updated as running means: a zettel's old embedding is
+    subtracted from the topics it left and its new one added to the topic
+    it joined. Each topic accumulates how far its centroid has moved; only
+    topics past DRIFT_THRESHOLD are split, merged into a near-identical
+    neighbour, or re-summarized, so the LLM is called for those alone.
+    The assignments and centroids are committed before any LLM call, and
+    new summaries are saved in a short transaction of their own.
+    """
+    DRIFT_THRESHOLD = 0.05
+    MERGE_SIMILARITY_THRESHOLD = 0.95
+    SPLIT_SILHOUETTE_THRESHOLD = 0.15
+    MIN_ZETTELS_TO_SPLIT = 10
+
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+        self.numZettelsAssigned = 0
+        self.numTopicsSplit = 0
+        self.numTopicsMerged = 0
+        self.numTopicsResummarized = 0
+        self.numTopicsDeleted = 0
+
+    def update_topics_from_file_sync(self, file_management_service):
+        self.update_topics(
+            list(file_management_service.changedZettelIds),
+            file_management_service.removedTopicMemberships
+        )
+
+    def update_topics(self, changed_zettel_ids: List[int], removed_memberships: Iterable[Tuple[int, np.ndarray]]):
+        """
+        changed_zettel_ids are new zettels and zettels whose content changed.
+        removed_memberships are (topic id, embedding) pairs for zettels that
+        were deleted, or that had that embedding before their content changed.
+        """
+        topics = db_session.query(ZettelkastenTopic).filter_by(user_id=self.user_id).order_by(ZettelkastenTopic.id).all()
+        if len(topics) == 0:
+            print("No topics to maintain yet, create them with ZettelkastenTopic.create_topics_from_experiment")
+            return
+        index_by_topic_id = {topic.id: i for i, topic in enumerate(topics)}
+        centroids = np.vstack([np.asarray(topic.centroid_instructor_base_embedding, dtype=np.float32) for topic in topics])
+        counts = np.array([topic.zettel_count for topic in topics], dtype=np.int64)
+        previous_centroids = centroids.copy()
+
+        for topic_id, embedding in removed_memberships:
+            if topic_id in index_by_topic_id:
+                self.remove_from_centroid(centroids, counts, index_by_topic_id[topic_id], np.asarray(embedding, dtype=np.float32))
+
+        # an emptied topic would keep attracting zettels with its stale centroid
+        kept = counts > 0
+        for topic in [topic for i, topic in enumerate(topics) if not kept[i]]:
+            print("Deleting empty topic: ", topic)
+            db_session.delete(topic)
+            self.numTopicsDeleted += 1
+        topics = [topic for i, topic in enumerate(topics) if kept[i]]
+        centroids, counts, previous_centroids = centroids[kept], counts[kept], previous_centroids[kept]
+        topic_ids = [topic.id for topic in topics]
+        if len(topics) == 0:
+            db_session.commit()
+            print("Every topic was emptied, recreate them with ZettelkastenTopic.create_topics_from_experiment")
+            return
+
+        if changed_zettel_ids:
+            # the stale memberships were already subtracted through removed_memberships
+            db_session.query(ZettelTopicAssociation)\
+                .filter(ZettelTopicAssociation.zettel_id.in_(changed_zettel_ids))\
+                .delete(synchronize_session=False)
+            zettel_ids, embeddings = load_vector_matrix(Zettel.id, Zettel.instructor_base_embedding, Zettel.id.in_(changed_zettel_ids))
+            labels = self.nearest_centroids(embeddings, centroids)
+            self.add_to_centroids(centroids, counts, labels, embeddings)
+            ZettelkastenTopic.assign_zettels_to_topics(zettel_ids.tolist(), embeddings, labels, topic_ids, centroids)
+            self.numZettelsAssigned += len(zettel_ids)
+
+        moved = 1.0 - np.sum(normalize_rows(previous_centroids) * normalize_rows(centroids), axis=1)
+        drifted = []
+        for i, topic in enumerate(topics):
+            topic.centroid_instructor_base_embedding = centroids[i]
+            topic.zettel_count = int(counts[i])
+            topic.drift = float(topic.drift or 0.0) + float(moved[i])
+            if topic.drift > self.DRIFT_THRESHOLD:
+                drifted.append(topic)
+        db_session.flush()
+
+        to_summarize = []
+        for topic in drifted:
+            to_summarize.extend(self.rebalance_topic(topic, topics))
+        # read before the commit expires them
+        summary_topic_ids = list(dict.fromkeys(topic.id for topic in to_summarize))
+        db_session.commit()
+        self.refresh_summaries(summary_topic_ids)
+        self.print_maintenance_info()
+
+    def rebalance_topic(self, topic: ZettelkastenTopic, topics: List[ZettelkastenTopic]) -> List[ZettelkastenTopic]:
+        """Returns the topics that need a new summary"""
+        merge_target = self.find_merge_target(topic, topics)
+        if merge_target is not None:
+            topics.remove(topic)
+            return self.merge_topics(merge_target, topic)
+        return self.split_topic(topic) or [topic]
+
+    def find_merge_target(self, topic: ZettelkastenTopic, topics: List[ZettelkastenTopic]):
+        others = [other for other in topics if other.id != topic.id]
+        if len(others) == 0:
+            return None
+        centroid = normalize_rows(np.asarray(topic.centroid_instructor_base_embedding, dtype=np.float32)[None, :])
+        other_centroids = normalize_rows(np.vstack([np.asarray(other.centroid_instructor_base_embedding, dtype=np.float32) for other in others]))
+        similarities = (other_centroids @ centroid.T)[:, 0]
+        best = int(np.argmax(similarities))
+        return others[best] if similarities[best] >= self.MERGE_SIMILARITY_THRESHOLD else None
+
+    def merge_topics(self, target: ZettelkastenTopic, source: ZettelkastenTopic) -> List[ZettelkastenTopic]:
+        """Moves every zettel of source into target and deletes source. Returns [target], which needs a new summary."""
+        print(f"Merging topic {source} into {target}")
+        total = target.zettel_count + source.zettel_count
+        target.centroid_instructor_base_embedding = (
+            np.asarray(target.centroid_instructor_base_embedding, dtype=np.float32) * target.zettel_count
+            + np.asarray(source.centroid_instructor_base_embedding, dtype=np.float32) * source.zettel_count
+        ) / total
+        target.zettel_count = total
+        db_session.execute(
+            update(ZettelTopicAssociation)
+            .where(ZettelTopicAssociation.topic_id == source.id)
+            .values(topic_id=target.id)
+        )
+        db_session.delete(source)
+        db_session.flush()
+        self.numTopicsMerged += 1
+        return [target]
+
+    def split_topic(self, topic: ZettelkastenTopic) -> List[ZettelkastenTopic]:
+        """Splits topic in two if its zettels form two well separated clusters. Returns both halves, or [] if it did not split."""
+        member_ids = select(ZettelTopicAssociation.zettel_id).where(ZettelTopicAssociation.topic_id == topic.id)
+        zettel_ids, embeddings = load_vector_matrix(Zettel.id, Zettel.instructor_base_embedding, Zettel.id.in_(member_ids))
+        if len(zettel_ids) < self.MIN_ZETTELS_TO_SPLIT:
+            return []
+        result = fit_kmeans(embeddings, 2)
+        if result.score < self.SPLIT_SILHOUETTE_THRESHOLD:
+            return []
+
+        print(f"Splitting topic {topic} (silhouette score {result.score:.4f})")
+        sizes = np.bincount(result.labels, minlength=2)
+        new_topic = ZettelkastenTopic(
+            name=topic.name,
+            user_id=topic.user_id,
+            centroid_instructor_base_embedding=result.centroids[1].astype(np.float32),
+            zettel_count=int(sizes[1]),
+        )
+        db_session.add(new_topic)
+        topic.centroid_instructor_base_embedding = result.centroids[0].astype(np.float32)
+        topic.zettel_count = int(sizes[0])
+        db_session.flush()
+        db_session.query(ZettelTopicAssociation)\
+            .filter(ZettelTopicAssociation.topic_id == topic.id)\
+            .delete(synchronize_session=False)
+        ZettelkastenTopic.assign_zettels_to_topics(zettel_ids.tolist(), embeddings, result.labels, [topic.id, new_topic.id], result.centroids)
+        self.numTopicsSplit += 1
+        return [topic, new_topic]
+
+    def refresh_summaries(self, topic_ids: List[int]):
+        """
+        Reads each topic's representative zettels and resets its drift in a
+        transaction that ends before calling the LLM, so a failed call does
+        not make the next sync rebalance the same topics again. The summaries
+        are then saved in a new, short transaction; topics deleted in the
+        meantime are skipped.
+        """
+        if len(topic_ids) == 0:
+            return
+        topics = db_session.query(ZettelkastenTopic).filter(ZettelkastenTopic.id.in_(topic_ids)).order_by(ZettelkastenTopic.id).all()
+        summarized_ids = [topic.id for topic in topics]
+        top_zettels = [
+            [
+                ZettelText(ztl.title, ztl.content)
+                for ztl, _score in Zettel.vector_search(np.asarray(topic.centroid_instructor_base_embedding, dtype=np.float32).tolist(), limit=7, user_id=self.user_id)
+            ]
+            for topic in topics
+        ]
+        for topic in topics:
+            topic.drift = 0.0
+        db_session.commit()
+
+        summaries = TopicSummarizer().summarize_many(top_zettels)
+
+        for topic_id, (summary, name) in zip(summarized_ids, summaries):
+            topic = db_session.get(ZettelkastenTopic, topic_id)
+            if topic is None:
+                continue
+            topic.description, topic.name = summary, name
+            self.numTopicsResummarized += 1
+        db_session.commit()
+
+    @classmethod
+    def nearest_centroids(cls, embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        if len(embeddings) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.argmax(normalize_rows(embeddings) @ normalize_rows(centroids).T, axis=1)
+
+    @classmethod
+    def add_to_centroids(cls, centroids: np.ndarray, counts: np.ndarray, labels: np.ndarray, embeddings: np.ndarray):
+        """Adds each embedding to the running mean of centroids[label], in place"""
+        if len(labels) == 0:
+            return
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, embeddings)
+        added = np.bincount(labels, minlength=len(centroids))
+        touched = added > 0
+        new_counts = counts + added
+        centroids[touched] = (centroids[touched] * counts[touched, None] + sums[touched]) / new_counts[touched, None]
+        counts[:] = new_counts
+
+    @classmethod
+    def remove_from_centroid(cls, centroids: np.ndarray, counts: np.ndarray, index: int, embedding: np.ndarray):
+        """Removes embedding from the running mean of centroids[index], in place. An emptied topic keeps its last centroid."""
+        if counts[index] <= 1:
+            counts[index] = 0
+            return
+        centroids[index] = (centroids[index] * counts[index] - embedding) / (counts[index] - 1)
+        counts[index] -= 1
+
+    def print_maintenance_info(self):
+        print(f"Assigned {self.numZettelsAssigned} changed zettels to topics")
+        print(f"Split {self.numTopicsSplit} topics, merged {self.numTopicsMerged}, deleted {self.numTopicsDeleted}, re-summarized {self.numTopicsResummarized}")
@@ -0,0 +1,86 @@
+import asyncio
+import random
+from typing import List, NamedTuple, Sequence, Tuple
+import anthropic
+from decouple import config
+
+
+SUMMARY_MODEL = "claude-3-5-sonnet-20240620"
+
+
+class ZettelText(NamedTuple):
+    """What a summary prompt needs of a zettel, detached from any session"""
+    title: str
+    content: str
+
+
+def zettels_prompt(zettels) -> str:
+    zettel_strings = ["[["+ztl.title+"]]"+"\n\n"+ztl.content for ztl in zettels]
+    return "The following are notes from my Zettelkasten. They are representative notes for a certain topic.\n\n" + "\n\n---\n\n".join(zettel_strings)
+
+
+class TopicSummarizer:
+    """
+    Writes a description and a name for each group of zettels.
+
+    A topic's name is asked for after its summary, but topics are summarized
+    concurrently, at most `max_concurrency` at a time. Rate limits, overload
+    and connection errors are retried with jittered exponential backoff.
+    """
+    retryable_errors = (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError)
+
+    def __init__(self, client=None, max_concurrency: int = 5, max_retries: int = 4, base_delay: float = 1.0) -> None:
+        # client is an AsyncAnthropic, or anything with an async messages.create. One is created per run if not given.
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+
+    def summarize_many(self, zettel_groups: Sequence[Sequence]) -> List[Tuple[str, str]]:
+        """Returns [summary, name] for each group, in order"""
+        if len(zettel_groups) == 0:
+            return []
+        return asyncio.run(self._summarize_all([zettels_prompt(zettels) for zettels in zettel_groups]))
+
+    async def _summarize_all(self, prompts: List[str]) -> List[Tuple[str, str]]:
+        client = self.client or anthropic.AsyncAnthropic(api_key=config('ANTHROPIC_API_KEY'))
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        try:
+            return await asyncio.gather(*[self._summarize(client, semaphore, prompt) for prompt in prompts])
+        finally:
+            if self.client is None:
+                await client.close()
+
+    async def _summarize(self, client, semaphore: asyncio.Semaphore, prompt: str) -> Tuple[str, str]:
+        async with semaphore:
+            summary = await self._create(
+                client,
+                messages=[
+                    {"role": "user", "content": prompt+"\n\nPlease give a description of this topic. Summarize it briefly."},
+                ],
+                max_tokens=100,
+                system="The user will provide notes that fit in a Zettelkasten topic group. They are written in markdown. Please summarize this topic briefly. Only include the summarization in your response. Do not use markdown."
+            )
+            name = await self._create(
+                client,
+                messages=[
+                    {"role": "user", "content": prompt},
+                    {"role": "assistant", "content": "Summary: " + summary},
+                    {"role": "user", "content": "Please make a name for this topic."},
+                ],
+                max_tokens=70,
+                system="The following are notes that fit in a Zettelkasten topic group. They are written in markdown. Please generate a title for the topic. Only include the title text in your response. Do not use markdown."
+            )
+        return summary, name
+
+    async def _create(self, client, **kwargs) -> str:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await client.messages.create(model=SUMMARY_MODEL, **kwargs)
+                return response.content[0].text
+            except self.retryable_errors as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.base_delay * (2 ** attempt) * (0.5 + random.random())
+                print(f"Summarization request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
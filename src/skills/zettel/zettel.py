@@ -6,17 +6,18 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql.expression import cast
 import uuid
-from src.skills.base import default_embeddings_model
-from src.models import db, Vector, db_session
+import numpy as np
+from src.skills.embedding_service import EmbeddingService
+from src.models import db, Vector, db_session, load_vector_matrix
 from .zettel_topic_association import ZettelTopicAssociation
 
 
 LOCAL_DOCS_FOLDER = config('LOCAL_DOCS_FOLDER')
 
+ZETTEL_EMBEDDING_INSTRUCTION = "Represent the personal Zettelkasten note for storing and retrieving personal insights: "
+
 def instructor_note_embed(doc_string) -> List[float]:
-    instruction = "Represent the personal Zettelkasten note for storing and retrieving personal insights: "
-    vec = default_embeddings_model.encode([[instruction, doc_string]]).tolist()
-    return vec[0]
+    return EmbeddingService.encode_one(ZETTEL_EMBEDDING_INSTRUCTION, doc_string)
 
 class Zettel(db.Model):
     __tablename__ = "zettels"
@@ -52,12 +53,20 @@ class Zettel(db.Model):
         return cls.vector_search(comparison_embedding, limit)
 
     @classmethod
-    def vector_search(cls, comparison_embedding: List[List[float]], limit=5) -> List[Tuple[Type["Zettel"], float]]:
-        """Returns list containing elements of [Zettel, float sim score]"""
+    def vector_search(cls, comparison_embedding: List[List[float]], limit=5, user_id: Optional[int] = None) -> List[Tuple[Type["Zettel"], float]]:
+        """Returns list containing elements of [Zettel, float sim score], only from user_id's zettels if given"""
         vector_cast = func.vector(cast(comparison_embedding, cls.instructor_base_embedding.type))
         similarity_scores = func.cosine_similarity(cls.instructor_base_embedding, vector_cast)
-        query = db_session.query(cls).with_entities(cls, similarity_scores).order_by(similarity_scores.desc()).limit(limit).all()
-        return [(item[0], item[1]) for item in query]
+        query = db_session.query(cls).with_entities(cls, similarity_scores)
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        results = query.order_by(similarity_scores.desc()).limit(limit).all()
+        return [(item[0], item[1]) for item in results]
+
+    @classmethod
+    def embedding_matrix(cls, user_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (zettel ids, (N, 768) float32 embeddings) without loading Zettel objects"""
+        return load_vector_matrix(cls.id, cls.instructor_base_embedding, cls.user_id == user_id)
 
     def similarity_score_for_topic(self, topic_id: int) -> Optional[float]:
         association = ZettelTopicAssociation.query.filter_by(topic_id=topic_id, zettel_id=self.id).first()
@@ -65,7 +74,10 @@ class Zettel(db.Model):
 
 
 def on_change_content(target, value, _oldvalue, _initiator):
-    target.instructor_base_embedding = instructor_note_embed(value)
-    target.sha = Zettel.doc_sha(value)
+    sha = Zettel.doc_sha(value)
+    if sha == target.sha and target.instructor_base_embedding is not None:
+        return
+    EmbeddingService.embed_on_flush(target, 'instructor_base_embedding', ZETTEL_EMBEDDING_INSTRUCTION, value)
+    target.sha = sha
 
 event.listen(Zettel.content, 'set', on_change_content)
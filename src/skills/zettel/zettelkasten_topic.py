@@ -1,14 +1,12 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Float, Integer, String, ForeignKey, insert
 from sqlalchemy.orm import relationship, Mapped
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
 import numpy as np
-from typing import List, Tuple
-from src.models import db, Vector, cosine_similarity, db_session
+from typing import List, Optional, Tuple
+from src.models import db, Vector, db_session, normalize_rows
 from .zettel import Zettel
 from .zettel_topic_association import ZettelTopicAssociation
-import anthropic
-from decouple import config
+from .cluster_selection import ClusterCountSelector, ClusteringResult, fit_kmeans
+from .topic_summarizer import TopicSummarizer
 
 
 class ZettelkastenTopic(db.Model):
@@ -20,6 +18,10 @@ class ZettelkastenTopic(db.Model):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     user = relationship("User", back_populates="topics")
     centroid_instructor_base_embedding = Column(Vector(768))
+    # kept up to date by TopicMaintenanceService so the centroid can be updated as a running mean
+    zettel_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # cumulative cosine distance the centroid has moved since the topic was last clustered or summarized
+    drift = Column(Float, nullable=False, default=0.0, server_default='0')
     zettels: Mapped[List[Zettel]] = relationship(secondary="zettel_topic_association", back_populates="topics")
 
     def __repr__(self):
@@ -37,80 +39,72 @@ class ZettelkastenTopic(db.Model):
         return association.similarity_score if association else None
 
     @classmethod
-    def perform_clustering(cls, embeddings: List[List[float]], num_clusters: int) -> Tuple[np.ndarray, np.ndarray, float]:
-        embeddings_array = [np.array(emb) for emb in embeddings]
-        kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-        cluster_labels = kmeans.fit_predict(embeddings_array)
-        centroids = kmeans.cluster_centers_
-        score = silhouette_score(embeddings_array, cluster_labels)
-        return cluster_labels, centroids, score
+    def perform_clustering(cls, embeddings: np.ndarray, num_clusters: int) -> Tuple[np.ndarray, np.ndarray, float]:
+        result = fit_kmeans(np.asarray(embeddings, dtype=np.float32), num_clusters)
+        return result.labels, result.centroids, result.score
 
     @classmethod
     def experiment_clustering(cls, embeddings: np.ndarray, min_clusters: int, max_clusters: int) -> List[Tuple[int, float]]:
-        results = []
-        for n_clusters in range(min_clusters, max_clusters + 1):
-            _, _, score = cls.perform_clustering(embeddings, n_clusters)
-            results.append((n_clusters, score))
-        return results
+        _best, results = ClusterCountSelector().search(embeddings, min_clusters, max_clusters)
+        return [(result.num_clusters, result.score) for result in results]
 
     @classmethod
     def summarize_zettels(cls, zettels):
-        zettel_strings = ["[["+ztl.title+"]]"+"\n\n"+ztl.content for ztl in zettels]
-        client = anthropic.Anthropic(
-            api_key=config('ANTHROPIC_API_KEY')
-        )
-        summary_messages = [
-            {"role": "user", "content": "The following are notes from my Zettelkasten. They are representative notes for a certain topic.\n\n"+"\n\n---\n\n".join(zettel_strings)+"\n\nPlease give a description of this topic. Summarize it briefly."},
-        ]
-        summary = client.messages.create(
-            messages=summary_messages,
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=100,
-            system="The user will provide notes that fit in a Zettelkasten topic group. They are written in markdown. Please summarize this topic briefly. Only include the summarization in your response. Do not use markdown."
-        ).content[0].text
-        name_messages = [
-            {"role": "user", "content": "The following are notes from my Zettelkasten. They are representative notes for a certain topic.\n\n" + "\n\n---\n\n".join(zettel_strings)},
-            {"role": "assistant", "content": "Summary: " + summary},
-            {"role": "user", "content": "Please make a name for this topic."},
-        ]
-        name = client.messages.create(
-            messages=name_messages,
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=70,
-            system="The following are notes that fit in a Zettelkasten topic group. They are written in markdown. Please generate a title for the topic. Only include the title text in your response. Do not use markdown."
-        ).content[0].text
-        return [summary, name]
+        return list(TopicSummarizer().summarize_many([zettels])[0])
 
     @classmethod
-    def create_topics(cls, zettels: List[Zettel], num_clusters: int):
-        embeddings = [ztl.instructor_base_embedding for ztl in zettels]
-        cluster_labels, centroids, _score = cls.perform_clustering(embeddings, num_clusters)
+    def create_topics(cls, user_id: int, zettel_ids: List[int], embeddings: np.ndarray, num_clusters: int, clustering: Optional[ClusteringResult] = None):
+        """
+        Clusters user_id's zettels into topics owned by that user. embeddings
+        is the (N, 768) matrix of the zettels' embeddings, rows in the order
+        of zettel_ids. clustering, if given, is an existing fit of those
+        embeddings with num_clusters clusters, which is used instead of refitting.
+        """
+        if clustering is None:
+            cluster_labels, centroids, _score = cls.perform_clustering(embeddings, num_clusters)
+        else:
+            cluster_labels, centroids = clustering.labels, clustering.centroids
+        cluster_sizes = np.bincount(np.asarray(cluster_labels), minlength=num_clusters)
+        top_zettels = [
+            [res[0] for res in Zettel.vector_search(centroids[i].tolist(), limit=7, user_id=user_id)]
+            for i in range(num_clusters)
+        ]
+        summaries = TopicSummarizer().summarize_many(top_zettels)
         topics = []
-        for i in range(num_clusters):
-            search_results = Zettel.vector_search(centroids[i].tolist(), limit=7)
-            top_zettels = [res[0] for res in search_results]
-            summary, name = cls.summarize_zettels(top_zettels)
-            topic = ZettelkastenTopic(name=name, description=summary, user_id=1, centroid_instructor_base_embedding=centroids[i].tolist())
+        for i, (summary, name) in enumerate(summaries):
+            topic = ZettelkastenTopic(name=name, description=summary, user_id=user_id, centroid_instructor_base_embedding=centroids[i].astype(np.float32), zettel_count=int(cluster_sizes[i]))
             db_session.add(topic)
-            db_session.commit()
             print("\n\ntopic: ", topic)
-            for j in range(len(zettels)):
-                if cluster_labels[j] != i:
-                    continue
-                score = cosine_similarity(zettels[j].instructor_base_embedding, centroids[i])
-                association = ZettelTopicAssociation(similarity_score=score, zettel_id=zettels[j].id, topic_id=topic.id)
-                db_session.add(association)
             topics.append(topic)
-            db_session.add(topic)
+        # ids are needed for the associations, everything is committed together below
+        db_session.flush()
+        cls.assign_zettels_to_topics(list(zettel_ids), embeddings, cluster_labels, [topic.id for topic in topics], centroids)
+        db_session.commit()
         print("topics: ", topics)
         print(topics)
         return topics
 
+    @classmethod
+    def assign_zettels_to_topics(cls, zettel_ids: List[int], embeddings: np.ndarray, cluster_labels: np.ndarray, topic_ids: List[int], centroids: np.ndarray) -> np.ndarray:
+        """
+        Associates each zettel with topic_ids[label], scored by cosine
+        similarity to that topic's centroid. All similarities come from one
+        matrix product and the associations are written in one INSERT.
+        Returns the (N, k) similarity matrix.
+        """
+        similarities = normalize_rows(embeddings) @ normalize_rows(centroids).T
+        cluster_labels = np.asarray(cluster_labels)
+        scores = similarities[np.arange(len(zettel_ids)), cluster_labels]
+        rows = [
+            {"zettel_id": int(zettel_id), "topic_id": topic_ids[label], "similarity_score": float(score)}
+            for zettel_id, label, score in zip(zettel_ids, cluster_labels, scores)
+        ]
+        if rows:
+            db_session.execute(insert(ZettelTopicAssociation), rows)
+        return similarities
+
     @classmethod
     def create_topics_from_experiment(cls, user_id: int, min_clusters: int, max_clusters: int):
-        zettels = db_session.query(Zettel).filter_by(user_id=1).all()
-        embeddings = [ztl.instructor_base_embedding for ztl in zettels]
-        topic_experiments = ZettelkastenTopic.experiment_clustering(embeddings, min_clusters, max_clusters)
-        best_experiment = max(topic_experiments, key=lambda x: x[1])
-        num_clusters = best_experiment[0]
-        return cls.create_topics(zettels, num_clusters)
+        zettel_ids, embeddings = Zettel.embedding_matrix(user_id)
+        best, _results = ClusterCountSelector().search(embeddings, min_clusters, max_clusters)
+        return cls.create_topics(user_id, zettel_ids.tolist(), embeddings, best.num_clusters, clustering=best)
@@ -1,15 +1,16 @@
 from decouple import config
 import os
 import time
-from src.skills.base import DocumentsBase, SkillBase, chroma_client, default_embeddings_model
+from src.skills.base import DocumentsBase, SkillBase
+from src.skills.embedding_service import EmbeddingService
+from src.skills.model_registry import lazy_collection
 from src.event_bus import register_event_listener
 
 def zettel_note_embed(doc_string):
     instruction = "Represent the personal Zettelkasten note for storing and retrieving personal insights: "
-    vec = default_embeddings_model.encode([[instruction, doc_string[0]]]).tolist()
-    return vec
+    return EmbeddingService.encode(instruction, doc_string).tolist()
 
-documents_collection = chroma_client.get_or_create_collection(name="documents_collection", embedding_function=zettel_note_embed)
+documents_collection = lazy_collection("documents_collection", zettel_note_embed)
 
 '''
 Zettelkasten document
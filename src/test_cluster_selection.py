@@ -0,0 +1,61 @@
+import unittest
+import numpy as np
+from src.skills.zettel.cluster_selection import ClusterCountSelector
+
+
+def make_blobs(num_blobs, points_per_blob, dim=16):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=10, size=(num_blobs, dim))
+    return np.vstack([center + rng.normal(size=(points_per_blob, dim)) for center in centers]).astype(np.float32)
+
+
+class TestClusterCountSelector(unittest.TestCase):
+
+    def test_picks_the_number_of_blobs(self):
+        # Given embeddings drawn from 4 well separated blobs
+        embeddings = make_blobs(4, 30)
+
+        # When we search between 2 and 6 clusters
+        best, results = ClusterCountSelector(max_workers=1).search(embeddings, 2, 6)
+
+        # Then every candidate is scored and the best fit has 4 clusters
+        self.assertEqual([result.num_clusters for result in results], [2, 3, 4, 5, 6])
+        self.assertEqual(best.num_clusters, 4)
+        # And the winning fit is kept, so it does not need to be refit
+        self.assertEqual(best.labels.shape, (120,))
+        self.assertEqual(best.centroids.shape, (4, 16))
+
+    def test_process_pool_matches_serial_search(self):
+        # Given embeddings large enough to use the process pool
+        embeddings = make_blobs(3, 40)
+        pooled = ClusterCountSelector(max_workers=2, min_rows_for_pool=0)
+        serial = ClusterCountSelector(max_workers=1)
+
+        # When both search the same range
+        pooled_best, pooled_results = pooled.search(embeddings, 2, 4)
+        serial_best, serial_results = serial.search(embeddings, 2, 4)
+
+        # Then they agree
+        self.assertEqual(pooled_best.num_clusters, serial_best.num_clusters)
+        self.assertEqual([r.score for r in pooled_results], [r.score for r in serial_results])
+
+    def test_samples_silhouette_for_large_inputs(self):
+        # Given more embeddings than the silhouette sample size
+        embeddings = make_blobs(3, 50)
+
+        # When we search with a small sample size
+        best, _results = ClusterCountSelector(max_workers=1, silhouette_sample_size=60).search(embeddings, 2, 4)
+
+        # Then the clusters are still found
+        self.assertEqual(best.num_clusters, 3)
+
+    def test_rejects_ranges_without_a_valid_cluster_count(self):
+        # Given two embeddings
+        # When we search for at least 2 clusters
+        # Then there is nothing to score
+        with self.assertRaises(ValueError):
+            ClusterCountSelector(max_workers=1).search(make_blobs(1, 2), 2, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+import src.skills.email.email_event_bus as email_event_bus
+from src.skills.email.email import Email
+from src.skills.email.email_event_bus import EmailCommandListener, EmailDispatcher, EmailEventBus
+# registers the remaining models User has relationships to
+import src.skills.interest
+import src.skills.zettel
+
+dispatched = []
+
+def record_email(email):
+    dispatched.append(email.gmail_id)
+
+def fail_on_email(email):
+    raise RuntimeError("listener failed")
+
+release_slow_listener = threading.Event()
+
+def block_on_email(email):
+    release_slow_listener.wait(timeout=10)
+    dispatched.append(email.gmail_id)
+
+
+def make_email(gmail_id, thread_id):
+    return Email(
+        user_id=1, gmail_id=gmail_id, thread_id=thread_id, from_email_address="sender@example.com",
+        to_email_address="bot@example.com", subject="Hello", received_at=datetime(2024, 1, 1),
+    )
+
+
+class TestEmailEventBus(unittest.TestCase):
+
+    def setUp(self):
+        # a file, so the listener worker threads share the database
+        handle, self.db_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.engine = create_engine('sqlite:///' + self.db_path)
+        Email.__table__.create(self.engine)
+        EmailCommandListener.__table__.create(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        patch.object(email_event_bus, 'db_session', self.session).start()
+        patch.object(email_event_bus, 'logging').start()
+        dispatched.clear()
+        release_slow_listener.clear()
+        EmailDispatcher._in_flight_threads.clear()
+
+    def tearDown(self):
+        release_slow_listener.set()
+        self.wait_until_returned("slow")
+        self.session.remove()
+        self.engine.dispose()
+        os.remove(self.db_path)
+        patch.stopall()
+
+    def add_listener_and_emails(self, thread_id, listener, gmail_ids):
+        self.session.add(EmailCommandListener(gmail_thread_id=thread_id, listener_function=__name__ + "." + listener.__name__))
+        self.session.add_all([make_email(gmail_id, thread_id) for gmail_id in gmail_ids])
+        self.session.commit()
+
+    def wait_until_returned(self, thread_id):
+        deadline = time.monotonic() + 5
+        while thread_id in EmailDispatcher._in_flight_threads and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def email(self, gmail_id):
+        self.session.expire_all()
+        return self.session.query(Email).filter_by(gmail_id=gmail_id).one()
+
+    def test_process_unhandled_emails_dispatches_listeners_and_bulk_marks_the_rest(self):
+        # Given a thread with a listener, a thread whose listener fails, and newsletters without one
+        self.session.add_all([
+            EmailCommandListener(gmail_thread_id="t1", listener_function=__name__ + ".record_email"),
+            EmailCommandListener(gmail_thread_id="t2", listener_function=__name__ + ".fail_on_email"),
+            make_email("m1", "t1"),
+            make_email("m2", "t1"),
+            make_email("m3", "t2"),
+            make_email("n1", "newsletter"),
+            make_email("n2", "newsletter"),
+        ])
+        self.session.commit()
+
+        # When the unhandled emails are processed
+        EmailEventBus.process_unhandled_emails()
+
+        # Then the listener saw its thread's emails
+        self.assertEqual(dispatched, ["m1", "m2"])
+        # And only the email whose listener failed is left unprocessed
+        unprocessed = [email.gmail_id for email in self.session.query(Email).filter_by(is_processed=False)]
+        self.assertEqual(unprocessed, ["m3"])
+        # And the listener was imported once
+        self.assertIs(EmailEventBus._listener_functions[__name__ + ".record_email"], record_email)
+
+    def test_failed_listeners_back_off_then_dead_letter(self):
+        # Given a thread whose listener always fails, followed by a second email in the same thread
+        self.add_listener_and_emails("t", fail_on_email, ["m1", "m2"])
+        dispatcher = EmailDispatcher(max_attempts=2, backoff_seconds=60)
+
+        # When it is dispatched
+        EmailEventBus.process_unhandled_emails()
+
+        # Then the failure is recorded with a backoff, and the thread's next email waits
+        m1 = self.email("m1")
+        self.assertEqual(m1.dispatch_attempts, 1)
+        self.assertIn("listener failed", m1.last_dispatch_error)
+        self.assertGreater(m1.next_dispatch_at, datetime.utcnow())
+        self.assertEqual(self.email("m2").dispatch_attempts, 0)
+
+        # And neither email of the thread is dispatched before the backoff has passed
+        EmailEventBus.process_unhandled_emails()
+        self.assertEqual(self.email("m1").dispatch_attempts, 1)
+        self.assertEqual(self.email("m2").dispatch_attempts, 0)
+
+        # And it is dead-lettered once its attempts run out
+        dispatcher.dispatch([(m1.id, "t", __name__ + ".fail_on_email")])
+        m1 = self.email("m1")
+        self.assertEqual(m1.dispatch_attempts, 2)
+        self.assertIsNotNone(m1.dispatch_failed_at)
+        self.assertFalse(m1.is_processed)
+
+    def test_slow_listener_is_not_dispatched_again_until_it_returns(self):
+        # Given a thread whose listener hangs and a thread whose listener is quick
+        self.add_listener_and_emails("slow", block_on_email, ["s1"])
+        self.add_listener_and_emails("fast", record_email, ["f1"])
+        due = [(self.email("s1").id, "slow", __name__ + ".block_on_email"), (self.email("f1").id, "fast", __name__ + ".record_email")]
+        dispatcher = EmailDispatcher(max_workers=2, timeout_seconds=0.2)
+        dispatcher.poll_seconds = 0.05
+
+        # When both are dispatched
+        dispatcher.dispatch(due)
+
+        # Then the quick thread was processed, and the hanging listener was not counted as a failure
+        self.assertTrue(self.email("f1").is_processed)
+        s1 = self.email("s1")
+        self.assertFalse(s1.is_processed)
+        self.assertEqual(s1.dispatch_attempts, 0)
+
+        # And a later dispatch skips the thread while its listener is still running
+        EmailEventBus.process_unhandled_emails()
+        self.assertEqual(dispatched, ["f1"])
+
+        # And once the listener returns, its email is processed exactly once
+        release_slow_listener.set()
+        self.wait_until_returned("slow")
+        self.assertTrue(self.email("s1").is_processed)
+        self.assertEqual(dispatched, ["f1", "s1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
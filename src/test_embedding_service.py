@@ -0,0 +1,188 @@
+import threading
+import unittest
+from multiprocessing import Pipe
+from unittest.mock import patch
+import numpy as np
+from sqlalchemy import create_engine, Column, Integer, PickleType, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+import src.skills.embedding_service as embedding_service
+import src.skills.embedding_worker as embedding_worker
+from src.skills.embedding_cache import EmbeddingCache
+from src.skills.embedding_service import EmbeddingService
+from src.skills.embedding_worker import EmbeddingWorker, EmbeddingWorkerClient
+
+Base = declarative_base()
+
+class Note(Base):
+    __tablename__ = 'notes'
+
+    id = Column(Integer, primary_key=True)
+    content = Column(Text)
+    embedding = Column(PickleType)
+
+
+class FakeEmbeddingsModel:
+    """Embeds each text as [len(text), len(instruction)] and records batches"""
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, pairs, batch_size=32):
+        self.batches.append([text for _, text in pairs])
+        return np.array([[len(text), len(instruction)] for instruction, text in pairs], dtype=np.float32)
+
+
+class TestEmbeddingService(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeEmbeddingsModel()
+        patch.object(embedding_service, 'default_embeddings_model', self.model).start()
+        patch.object(EmbeddingService, 'batch_size', 2).start()
+        self.cache = EmbeddingCache(':memory:', max_entries=3)
+        patch.object(embedding_service, 'embedding_cache', self.cache).start()
+
+        self.engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        Base.metadata.drop_all(bind=self.engine)
+        patch.stopall()
+
+    def test_encode_batches_by_length_and_keeps_order(self):
+        # Given texts of varying length
+        texts = ["ccc", "a", "dddd", "bb", "eeeee"]
+
+        # When we encode them with a batch size of 2
+        vectors = EmbeddingService.encode("inst: ", texts)
+
+        # Then the model sees length-sorted batches of at most 2
+        self.assertEqual(self.model.batches, [["a", "bb"], ["ccc", "dddd"], ["eeeee"]])
+        # And the vectors come back in the original order
+        self.assertEqual(vectors[:, 0].tolist(), [3, 1, 4, 2, 5])
+
+    def test_embed_on_flush_encodes_pending_objects_together(self):
+        # Given three notes whose embeddings are deferred until flush
+        notes = [Note(content=text) for text in ["one", "three", "fifteen"]]
+        for note in notes:
+            EmbeddingService.embed_on_flush(note, 'embedding', "inst: ", note.content)
+            self.session.add(note)
+        self.assertEqual(self.model.batches, [])
+
+        # When the session commits
+        self.session.commit()
+
+        # Then all notes were embedded in batches during the flush
+        self.assertEqual(self.model.batches, [["one", "three"], ["fifteen"]])
+        self.assertEqual([note.embedding[0] for note in notes], [3, 5, 7])
+
+    def test_embed_on_flush_skips_objects_outside_the_session(self):
+        # Given a note that was never added to the session
+        note = Note(content="orphan")
+        EmbeddingService.embed_on_flush(note, 'embedding', "inst: ", note.content)
+
+        # When an unrelated session flushes
+        self.session.add(Note(content="other"))
+        self.session.commit()
+
+        # Then the orphaned note is left pending
+        self.assertIsNone(note.embedding)
+        self.assertIn(note, EmbeddingService._pending())
+
+    def test_cached_texts_are_not_re_encoded(self):
+        # Given texts that were embedded before
+        EmbeddingService.encode("inst: ", ["a", "bb"])
+
+        # When they are encoded again alongside a new and a duplicated text
+        vectors = EmbeddingService.encode("inst: ", ["bb", "ccc", "a", "ccc"])
+
+        # Then only the new text reaches the model, once
+        self.assertEqual(self.model.batches, [["a", "bb"], ["ccc"]])
+        self.assertEqual(vectors[:, 0].tolist(), [2, 3, 1, 3])
+
+    def test_cache_is_keyed_by_instruction(self):
+        # Given a text embedded with one instruction
+        EmbeddingService.encode("inst: ", ["a"])
+
+        # When the same text is embedded with another instruction
+        vectors = EmbeddingService.encode("other instruction: ", ["a"])
+
+        # Then it is encoded again
+        self.assertEqual(self.model.batches, [["a"], ["a"]])
+        self.assertEqual(vectors[0].tolist(), [1, len("other instruction: ")])
+
+    def test_cache_evicts_least_recently_used(self):
+        # Given a full cache where "a" was used most recently
+        EmbeddingService.encode("inst: ", ["a", "bb", "ccc"])
+        EmbeddingService.encode("inst: ", ["a"])
+
+        # When a fourth text is cached
+        EmbeddingService.encode("inst: ", ["dddd"])
+
+        # Then the least recently used entry was evicted
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(
+            set(self.cache.get_many(embedding_service.DEFAULT_EMBEDDINGS_MODEL_NAME, "inst: ", ["a", "bb", "ccc", "dddd"])),
+            {0, 2, 3}
+        )
+
+    def test_cache_reads_do_not_write(self):
+        # Given a cached text
+        EmbeddingService.encode("inst: ", ["a"])
+        changes = self.cache._connect().total_changes
+
+        # When it is read again
+        EmbeddingService.encode("inst: ", ["a"])
+
+        # Then nothing was written, the touch waits for the next put
+        self.assertEqual(self.cache._connect().total_changes, changes)
+        self.assertEqual(len(self.cache._pending_touches), 1)
+
+
+class TestEmbeddingWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeEmbeddingsModel()
+        patch.object(embedding_service, 'default_embeddings_model', self.model).start()
+        patch.object(embedding_service, 'embedding_cache', EmbeddingCache(':memory:', max_entries=10)).start()
+
+        # Given a worker serving one end of a pipe, and a client holding the other
+        worker_end, client_end = Pipe()
+        self.worker_thread = threading.Thread(target=EmbeddingWorker("unused", authkey="test").handle_connection, args=(worker_end,))
+        self.worker_thread.start()
+        self.client = EmbeddingWorkerClient("unused", authkey="test")
+        self.client._local.connection = client_end
+        patch.object(embedding_service, 'embedding_worker_client', self.client).start()
+
+    def tearDown(self):
+        self.client._disconnect()
+        self.worker_thread.join(timeout=5)
+        patch.stopall()
+
+    def test_encode_is_served_by_the_worker(self):
+        # When the service encodes texts
+        vectors = EmbeddingService.encode("inst: ", ["ccc", "a"])
+
+        # Then the worker ran the model and the vectors are returned in order
+        self.assertEqual(self.model.batches, [["a", "ccc"]])
+        self.assertEqual(vectors[:, 0].tolist(), [3, 1])
+
+    def test_worker_refuses_to_start_without_an_authkey(self):
+        # When no authkey is configured
+        # Then neither side can be created
+        with patch.object(embedding_worker, 'EMBEDDING_WORKER_AUTHKEY', None):
+            with self.assertRaises(ValueError):
+                EmbeddingWorker("unused")
+            with self.assertRaises(ValueError):
+                EmbeddingWorkerClient("unused")
+
+    def test_worker_errors_are_raised_in_the_client(self):
+        # When the worker is sent an unknown command
+        # Then the client raises
+        with self.assertRaises(RuntimeError):
+            self.client._request(("unknown",))
+
+
+if __name__ == '__main__':
+    unittest.main()
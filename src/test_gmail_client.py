@@ -0,0 +1,414 @@
+import base64
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import httplib2
+from googleapiclient.errors import HttpError
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import scoped_session, sessionmaker
+import src.skills.email.email as email_module
+import src.skills.email.gmail_client as gmail_client_module
+import src.skills.email.gmail_sync_cursor as gmail_sync_cursor_module
+import src.skills.email.mailbox_sync as mailbox_sync
+import src.skills.email.oauth_credential as oauth_credential_module
+from src.skills.email.email import Email
+from src.skills.email.gmail_client import GmailClient
+from src.skills.email.gmail_sync_cursor import GmailSyncCursor
+from src.skills.email.oauth_credential import OAuthCredential
+# registers the remaining models User has relationships to
+import src.skills.interest
+import src.skills.zettel
+
+
+def raw_gmail(gmail_id, subject="Hello", thread_id=None, history_id="100", body="Hi there"):
+    return {
+        "id": gmail_id,
+        "threadId": thread_id or "thread-" + gmail_id,
+        "snippet": "snippet",
+        "historyId": history_id,
+        "internalDate": "1700000000000",
+        "payload": {"mimeType": "text/plain", "body": {"data": base64.urlsafe_b64encode(body.encode()).decode()}, "headers": [
+            {"name": "From", "value": "sender@example.com"},
+            {"name": "To", "value": "bot@example.com"},
+            {"name": "Subject", "value": subject},
+            {"name": "Message-ID", "value": "<" + gmail_id + "@example.com>"},
+        ]},
+    }
+
+
+class FakeRequest:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.batch_sizes.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeHistory:
+    """Serves users().history().list one page per entry of pages, or a 404 if expired"""
+    def __init__(self, pages, expired=False):
+        self.pages = pages
+        self.expired = expired
+        self.list_kwargs = []
+
+    def list(self, userId, **kwargs):
+        self.list_kwargs.append(kwargs)
+        def fetch():
+            if self.expired:
+                raise HttpError(httplib2.Response({"status": 404}), b"history id too old")
+            return self.pages[int(kwargs.get("pageToken") or 0)]
+        return FakeRequest(fetch)
+
+
+class FakeThreads:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, userId, id, **kwargs):
+        def fetch():
+            self.service.fetched_thread_ids.append(id)
+            return {"id": id, "messages": [raw for raw in self.service.raw_emails if raw["threadId"] == id]}
+        return FakeRequest(fetch)
+
+
+class FakeGmailService:
+    """Serves users().messages() list and get, getProfile, and batches, from an in-memory mailbox"""
+    def __init__(self, raw_emails, page_size=3, rate_limited_ids=(), history=None, history_id="500"):
+        self.raw_emails = raw_emails
+        self.page_size = page_size
+        self.rate_limited_ids = set(rate_limited_ids)
+        self.fake_history = history or FakeHistory([])
+        self.history_id = history_id
+        self.batch_sizes = []
+        self.fetched_ids = []
+        self.get_kwargs = []
+        self.num_list_calls = 0
+        self.fetched_thread_ids = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self.fake_history
+
+    def threads(self):
+        return FakeThreads(self)
+
+    def getProfile(self, userId):
+        return FakeRequest(lambda: {"historyId": self.history_id})
+
+    def list(self, userId, pageToken=None):
+        self.num_list_calls += 1
+        start = int(pageToken or 0)
+        page = self.raw_emails[start:start + self.page_size]
+        result = {"messages": [{"id": raw["id"]} for raw in page]}
+        if start + self.page_size < len(self.raw_emails):
+            result["nextPageToken"] = str(start + self.page_size)
+        return FakeRequest(lambda: result)
+
+    def get(self, userId, id, **kwargs):
+        self.get_kwargs.append(kwargs)
+        def fetch():
+            if id in self.rate_limited_ids:
+                self.rate_limited_ids.remove(id)
+                raise HttpError(httplib2.Response({"status": 429}), b"rate limited")
+            self.fetched_ids.append(id)
+            return next(raw for raw in self.raw_emails if raw["id"] == id)
+        return FakeRequest(fetch)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+class TestGmailClient(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        Email.__table__.create(self.engine)
+        GmailSyncCursor.__table__.create(self.engine)
+        OAuthCredential.__table__.create(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        patch.object(gmail_client_module, 'db_session', self.session).start()
+        patch.object(email_module, 'db_session', self.session).start()
+        patch.object(gmail_sync_cursor_module, 'db_session', self.session).start()
+        patch.object(oauth_credential_module, 'db_session', self.session).start()
+        patch.object(gmail_client_module.time, 'sleep').start()
+        patch.object(Email, 'bulk_upsert_from_raw_gmail', self.sqlite_bulk_upsert).start()
+
+    def tearDown(self):
+        GmailClient.forget(1)
+        self.session.remove()
+        patch.stopall()
+
+    def sqlite_bulk_upsert(self, raw_emails, user_id):
+        """Stands in for the PostgreSQL upsert, which SQLite cannot run"""
+        inserted = 0
+        for raw_email in raw_emails:
+            attributes = Email.attributes_from_raw_gmail(raw_email, user_id)
+            existing = self.session.query(Email).filter_by(gmail_id=raw_email["id"]).first()
+            if existing is None:
+                self.session.add(Email(**attributes))
+                inserted += 1
+                continue
+            for attribute in Email.GMAIL_ATTRIBUTES:
+                setattr(existing, attribute, attributes[attribute])
+        return inserted, len(raw_emails) - inserted
+
+    def test_full_sync_fetches_new_messages_in_batches(self):
+        # Given a mailbox of 7 messages, one of which is already synced
+        service = FakeGmailService([raw_gmail(f"m{i}") for i in range(7)])
+        GmailClient(user_id=1, gmail_service=FakeGmailService([raw_gmail("m1")])).fetch_emails_full_sync()
+
+        # When we run a full sync with a batch size of 2
+        with patch.object(gmail_client_module, 'GMAIL_BATCH_SIZE', 2):
+            num_created = GmailClient(user_id=1, gmail_service=service).fetch_emails_full_sync()
+
+        # Then only the 6 missing messages were fetched, in batches of at most 2 per page of 3
+        self.assertEqual(sorted(service.fetched_ids), ["m0", "m2", "m3", "m4", "m5", "m6"])
+        self.assertEqual(service.batch_sizes, [2, 2, 1, 1])
+        self.assertEqual(num_created, 6)
+        self.assertEqual(self.session.query(Email).count(), 7)
+
+    def test_sync_requests_only_the_headers_it_stores(self):
+        # Given a mailbox with one message
+        service = FakeGmailService([raw_gmail("m0")])
+        client = GmailClient(user_id=1, gmail_service=service)
+
+        # When we sync it and then read its content
+        client.fetch_emails_full_sync()
+        client.get_message("m0")
+
+        # Then the sync fetched metadata only, and the content was fetched in full on demand
+        self.assertEqual(service.get_kwargs, [
+            {"format": "metadata", "metadataHeaders": ["From", "To", "Subject", "Message-ID"]},
+            {"format": "full"},
+        ])
+
+    def test_rate_limited_messages_are_retried(self):
+        # Given a mailbox where fetching one message is rate limited once
+        service = FakeGmailService([raw_gmail("m0"), raw_gmail("m1")], rate_limited_ids=["m1"])
+
+        # When we fetch both messages
+        raw_emails = GmailClient(user_id=1, gmail_service=service).get_messages(["m0", "m1"])
+
+        # Then the rate limited message was fetched in a second batch
+        self.assertEqual(sorted(raw_emails), ["m0", "m1"])
+        self.assertEqual(service.batch_sizes, [2, 1])
+
+    def test_existing_records_are_updated_when_requested(self):
+        # Given an email that was synced before its subject changed
+        GmailClient(user_id=1, gmail_service=FakeGmailService([raw_gmail("m0", subject="Old")])).fetch_emails_full_sync()
+        service = FakeGmailService([raw_gmail("m0", subject="New")])
+
+        # When we run a full sync that updates existing records
+        GmailClient(user_id=1, gmail_service=service).fetch_emails_full_sync(update_existing_records=True)
+
+        # Then the email was updated rather than duplicated
+        self.assertEqual([email.subject for email in self.session.query(Email).all()], ["New"])
+
+    def test_full_sync_stores_the_history_cursor(self):
+        # When a user without a cursor syncs
+        GmailClient(user_id=1, gmail_service=FakeGmailService([raw_gmail("m0")], history_id="700")).sync()
+
+        # Then the whole mailbox was synced and the cursor is the profile's historyId
+        self.assertEqual(self.session.query(Email).count(), 1)
+        self.assertEqual(GmailSyncCursor.history_id_for(1), "700")
+
+    def test_sync_fetches_only_changed_messages_from_history(self):
+        # Given a stored cursor and two pages of history with added messages and label changes
+        GmailSyncCursor.create_or_update(1, "100")
+        history = FakeHistory([
+            {"history": [{"messagesAdded": [{"message": {"id": "m1"}}]}], "nextPageToken": "1", "historyId": "150"},
+            {"history": [
+                {"labelsAdded": [{"message": {"id": "m0"}, "labelIds": ["STARRED"]}]},
+                {"messagesAdded": [{"message": {"id": "m1"}}]},
+            ], "historyId": "200"},
+        ])
+        service = FakeGmailService([raw_gmail("m0"), raw_gmail("m1"), raw_gmail("m2")], history=history)
+
+        # When the user syncs
+        GmailClient(user_id=1, gmail_service=service).sync()
+
+        # Then only the changed messages were fetched, without listing the mailbox
+        self.assertEqual(service.fetched_ids, ["m1", "m0", "m1"])
+        self.assertEqual(service.num_list_calls, 0)
+        self.assertEqual(history.list_kwargs[0]["historyTypes"], ["messageAdded", "labelAdded"])
+        # And the cursor moved to the latest historyId
+        self.assertEqual(GmailSyncCursor.history_id_for(1), "200")
+
+    def test_expired_cursor_falls_back_to_full_sync(self):
+        # Given a cursor the history API no longer knows
+        GmailSyncCursor.create_or_update(1, "1")
+        service = FakeGmailService([raw_gmail("m0")], history=FakeHistory([], expired=True), history_id="900")
+
+        # When the user syncs
+        GmailClient(user_id=1, gmail_service=service).sync()
+
+        # Then the mailbox was fully synced and the cursor reset
+        self.assertEqual(service.fetched_ids, ["m0"])
+        self.assertEqual(GmailSyncCursor.history_id_for(1), "900")
+
+    def add_credential(self, expiry):
+        self.session.add(OAuthCredential(
+            user_id=1, token="expired", refresh_token="refresh", token_uri="https://oauth2.googleapis.com/token",
+            client_id="client", client_secret="secret", scopes='["https://www.googleapis.com/auth/gmail.readonly"]',
+            expiry=expiry,
+        ))
+        self.session.commit()
+
+    def test_clients_are_cached_and_refreshed_tokens_persisted(self):
+        # Given a user whose stored access token has expired
+        self.add_credential(datetime.utcnow() - timedelta(hours=1))
+
+        def refresh(credentials, _request):
+            credentials.token = "fresh"
+            credentials.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        # When the client is requested twice
+        with patch('google.oauth2.credentials.Credentials.refresh', autospec=True, side_effect=refresh) as mock_refresh, \
+                patch.object(self.session, 'commit', wraps=self.session.commit) as caller_commit:
+            client = GmailClient.for_user(1)
+            self.assertIs(GmailClient.for_user(1), client)
+
+        # Then the token was refreshed once and written back, without committing the caller's session
+        self.assertEqual(mock_refresh.call_count, 1)
+        self.assertEqual(caller_commit.call_count, 0)
+        self.assertEqual(self.session.query(OAuthCredential).filter_by(user_id=1).one().token, "fresh")
+        # And the service was built from the bundled discovery document
+        self.assertTrue(hasattr(client.gmail_service.users(), "history"))
+
+    def test_each_thread_sends_through_its_own_http_with_a_timeout(self):
+        # Given a client for a user with a valid token
+        self.add_credential(datetime.utcnow() + timedelta(hours=1))
+        client = GmailClient.for_user(1)
+
+        # When requests are built on two threads
+        requests = []
+        build = lambda: requests.append(client._build_request(None, lambda _resp, content: content, "https://gmail.googleapis.com/"))
+        build()
+        thread = threading.Thread(target=build)
+        thread.start()
+        thread.join()
+
+        # Then each thread has its own connection, with a socket timeout and without following 308s
+        first, second = [request.http.http for request in requests]
+        self.assertIsNot(first, second)
+        self.assertIsNotNone(first.timeout)
+        self.assertNotIn(308, first.redirect_codes)
+
+    def test_chat_history_fetches_the_thread_once_and_backfills_missing_emails(self):
+        # Given a thread of which only the first message has been synced
+        service = FakeGmailService([raw_gmail("m0", thread_id="t", body="First")])
+        client = GmailClient(user_id=1, gmail_service=service)
+        client.fetch_emails_full_sync()
+        service.raw_emails.append(raw_gmail("m1", thread_id="t", body="Second"))
+        service.fetched_ids.clear()
+
+        # When its chat history is built twice
+        first = client.thread_as_chat_history("t")
+        second = client.thread_as_chat_history("t")
+
+        # Then the whole thread came from a single threads.get, and no message was fetched on its own
+        self.assertEqual([message["content"] for message in first], ["First", "Second"])
+        self.assertEqual(second, first)
+        self.assertEqual(service.fetched_thread_ids, ["t"])
+        self.assertEqual(service.fetched_ids, [])
+        # And the missing email was created
+        self.assertEqual(self.session.query(Email).filter_by(thread_id="t").count(), 2)
+
+        # And once a message changes the thread is fetched again
+        self.session.query(Email).filter_by(gmail_id="m1").one().history_id = "200"
+        client.thread_as_chat_history("t")
+        self.assertEqual(service.fetched_thread_ids, ["t", "t"])
+
+    def test_messages_without_a_text_body_are_cached_too(self):
+        # Given a thread whose second message is only an attachment
+        attachment = raw_gmail("m1", thread_id="t")
+        attachment["payload"]["mimeType"] = "application/pdf"
+        service = FakeGmailService([raw_gmail("m0", thread_id="t", body="First"), attachment])
+        client = GmailClient(user_id=1, gmail_service=service)
+
+        # When its chat history is built twice
+        first = client.thread_as_chat_history("t")
+        second = client.thread_as_chat_history("t")
+
+        # Then the attachment is left out of the history, and the thread was fetched only once
+        self.assertEqual([message["content"] for message in first], ["First"])
+        self.assertEqual(second, first)
+        self.assertEqual(service.fetched_thread_ids, ["t"])
+
+
+class TestMailboxSync(unittest.TestCase):
+
+    def test_mailboxes_sync_concurrently_and_failures_are_isolated(self):
+        # Given three users whose syncs only finish once all three are running, and one that fails
+        barrier = threading.Barrier(3, timeout=5)
+
+        class FakeGmailClient:
+            def __init__(self, user_id):
+                self.user_id = user_id
+
+            @classmethod
+            def for_user(cls, user_id):
+                return cls(user_id)
+
+            def sync(self):
+                barrier.wait()
+                if self.user_id == 2:
+                    raise RuntimeError("invalid_grant")
+                return self.user_id * 10
+
+        # When the mailboxes are synced on three workers
+        with patch.object(mailbox_sync, 'GmailClient', FakeGmailClient):
+            results = mailbox_sync.sync_mailboxes([1, 2, 3], max_workers=3)
+
+        # Then every user has a result, in order, and the failure did not stop the others
+        self.assertEqual([result.user_id for result in results], [1, 2, 3])
+        self.assertEqual([result.num_created for result in results], [10, 0, 30])
+        self.assertIsInstance(results[1].error, RuntimeError)
+        self.assertIsNone(results[0].error)
+        self.assertTrue(all(result.seconds >= 0 for result in results))
+
+
+class TestEmailUpsert(unittest.TestCase):
+
+    def test_upsert_updates_only_gmail_columns_and_reports_inserts(self):
+        # Given the row for a raw Gmail message
+        rows = [Email.attributes_from_raw_gmail(raw_gmail("m0"), 1)]
+
+        # When the upsert statement is compiled for PostgreSQL
+        sql = str(Email.upsert_statement(rows).compile(dialect=postgresql.dialect()))
+
+        # Then conflicts on gmail_id update the Gmail columns but leave is_processed alone
+        self.assertIn("ON CONFLICT (gmail_id) DO UPDATE SET", sql)
+        self.assertIn("subject = excluded.subject", sql)
+        self.assertNotIn("is_processed = excluded", sql)
+        # And each returned row says whether it was inserted
+        self.assertIn("xmax = 0 AS inserted", sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+import math
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+import src.skills.email.email_event_bus as email_event_bus
+import src.skills.email.enqueued_message as enqueued_message
+import src.skills.email.message_queue as message_queue
+from src.skills.email.email_event_bus import EmailCommandListener
+from src.skills.email.enqueued_message import EnqueuedMessage
+from src.skills.email.message_queue import MessageQueue, count_waking_hours
+from src.skills.email.outgoing_message_scheduler import OutgoingMessageScheduler
+# registers the remaining models User has relationships to
+import src.skills.interest
+import src.skills.zettel
+
+
+def count_waking_hours_by_stepping(start, end, hour_awake, hour_bedtime):
+    waking_hours = 0
+    current = start
+    while current <= end:
+        if current.hour >= hour_awake and current.hour < hour_bedtime:
+            waking_hours += 1
+        current += timedelta(hours=1)
+    return waking_hours
+
+
+class TestMessageQueue(unittest.TestCase):
+
+    def test_closed_form_waking_hours_match_stepping_hour_by_hour(self):
+        # Given sent times spread over several days and a range of waking windows
+        rng = np.random.default_rng(0)
+        now = datetime(2024, 3, 10, 15, 20)
+        sent_at = [now - timedelta(minutes=int(minutes)) for minutes in rng.integers(0, 60 * 80, size=200)]
+        hours_since_sent = np.array([(now - sent).total_seconds() / 3600 for sent in sent_at])
+
+        for hour_awake, hour_bedtime in [(9, 17), (0, 24), (7, 23), (12, 13)]:
+            # When the waking hours are computed in closed form
+            waking_hours = count_waking_hours(np.array([sent.hour for sent in sent_at]), hours_since_sent, hour_awake, hour_bedtime)
+
+            # Then they equal the hour by hour count
+            expected = [count_waking_hours_by_stepping(sent, now, hour_awake, hour_bedtime) for sent in sent_at]
+            self.assertEqual(waking_hours.tolist(), expected)
+
+    def test_running_load_decays_and_accumulates_sent_messages(self):
+        # Given a queue with no load
+        start = datetime(2024, 3, 10, 9, 0)
+        queue = MessageQueue(user_attention_bandwidth_minutes=120, decayed_load_minutes=0.0, decayed_load_updated_at=start)
+
+        # When a 30 minute message is sent, then a 10 minute one six hours later
+        queue.add_sent_load(30, start)
+        queue.add_sent_load(10, start + timedelta(hours=6))
+
+        # Then the load six more hours later is each message decayed by its age
+        load = queue.current_decayed_load(start + timedelta(hours=12))
+        self.assertAlmostEqual(load, 30 * math.exp(-2) + 10 * math.exp(-1))
+
+
+class FakeQueue:
+    def __init__(self, id, bandwidth, load, user):
+        self.id = id
+        self.user_id = user.id
+        self.user = user
+        self.user_attention_bandwidth_minutes = bandwidth
+        self.load = load
+        self.sent = []
+
+    def current_decayed_load(self, now):
+        return self.load
+
+
+def fake_send_batch(user_id, queued_messages):
+    for queue, message in queued_messages:
+        queue.sent.append(message.id)
+    return len(queued_messages)
+
+
+class TestOutgoingMessageScheduler(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(MessageQueue, 'send_batch', side_effect=fake_send_batch).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_user_budget_is_shared_across_queues_and_filled_greedily(self):
+        # Given a user with two queues whose loads leave 30 minutes of a 60 minute budget
+        user = SimpleNamespace(id=1, hour_awake=9, hour_bedtime=17)
+        first, second = FakeQueue(1, 60, 10, user), FakeQueue(2, 90, 20, user)
+        start = datetime(2024, 3, 10, 8, 0)
+        pending = {
+            1: [SimpleNamespace(id=10, queue_id=1, created_at=start + timedelta(hours=1), estimated_time=20),
+                SimpleNamespace(id=11, queue_id=1, created_at=start + timedelta(hours=2), estimated_time=5)],
+            2: [SimpleNamespace(id=20, queue_id=2, created_at=start, estimated_time=25)],
+        }
+
+        # When the scheduler runs during waking hours
+        remaining = OutgoingMessageScheduler.remaining_budget([first, second], datetime(2024, 3, 10, 10, 0))
+        num_sent = OutgoingMessageScheduler().schedule_user([first, second], pending, remaining)
+
+        # Then the oldest message is sent first, and then only what still fits the shared budget
+        self.assertEqual(num_sent, 2)
+        self.assertEqual(second.sent, [20])
+        self.assertEqual(first.sent, [11])
+
+    def test_nothing_is_sent_while_the_user_sleeps(self):
+        # Given a queue with plenty of budget
+        user = SimpleNamespace(id=1, hour_awake=9, hour_bedtime=17)
+        queue = FakeQueue(1, 120, 0, user)
+
+        # When the scheduler runs at night
+        remaining = OutgoingMessageScheduler.remaining_budget([queue], datetime(2024, 3, 10, 22, 0))
+
+        # Then there is no budget to send anything
+        self.assertEqual(remaining, 0)
+
+
+class TestPendingMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        EnqueuedMessage.__table__.create(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        patch.object(enqueued_message, 'db_session', self.session).start()
+
+    def tearDown(self):
+        self.session.remove()
+        patch.stopall()
+
+    def enqueue(self, queue_id, created_at, sent_at=None, estimated_time=1):
+        message = EnqueuedMessage(content="hi", estimated_time=estimated_time, queue_id=queue_id, recipient_email="a@b.c", subject="hi", created_at=created_at, sent_at=sent_at)
+        self.session.add(message)
+        self.session.commit()
+        return message.id
+
+    def test_pending_for_queues_returns_the_oldest_unsent_messages_of_each_queue(self):
+        # Given two queues with sent and unsent messages, and a third queue that is not asked for
+        start = datetime(2024, 3, 10, 8, 0)
+        sent = self.enqueue(1, start, sent_at=start)
+        newest = self.enqueue(1, start + timedelta(hours=3))
+        oldest = self.enqueue(1, start + timedelta(hours=1))
+        middle = self.enqueue(1, start + timedelta(hours=2))
+        other = self.enqueue(2, start + timedelta(hours=5))
+        self.enqueue(3, start)
+
+        # When the two oldest pending messages per queue are loaded
+        pending = EnqueuedMessage.pending_for_queues({1: 60, 2: 60}, limit_per_queue=2)
+
+        # Then each queue contributes its oldest unsent messages in order
+        self.assertEqual([message.id for message in pending], [oldest, middle, other])
+        self.assertNotIn(sent, [message.id for message in pending])
+        self.assertNotIn(newest, [message.id for message in pending])
+
+    def test_messages_too_long_for_the_budget_do_not_crowd_out_shorter_ones(self):
+        # Given 20 long messages queued before a short one
+        start = datetime(2024, 3, 10, 8, 0)
+        for i in range(20):
+            self.enqueue(1, start + timedelta(minutes=i), estimated_time=45)
+        short = self.enqueue(1, start + timedelta(hours=1), estimated_time=5)
+
+        # When candidates are loaded for a 10 minute budget
+        pending = EnqueuedMessage.pending_for_queues({1: 10}, limit_per_queue=20)
+
+        # Then the short message is the candidate
+        self.assertEqual([message.id for message in pending], [short])
+
+
+class FakeGmailClient:
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.sent = []
+
+    def send_message(self, enqueued_message):
+        if enqueued_message.id == self.fail_on:
+            raise ConnectionError("send failed")
+        self.sent.append(enqueued_message.id)
+        return {'threadId': f"thread-{enqueued_message.id}"}
+
+
+class TestSendBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        for table in [MessageQueue.__table__, EnqueuedMessage.__table__, EmailCommandListener.__table__]:
+            table.create(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        for module in [enqueued_message, message_queue, email_event_bus]:
+            patch.object(module, 'db_session', self.session).start()
+
+        self.queue = MessageQueue(name="q", user_id=1, decayed_load_minutes=0.0, decayed_load_updated_at=datetime.now())
+        self.session.add(self.queue)
+        self.session.add(EmailCommandListener(gmail_thread_id="thread-2", listener_function="old.listener"))
+        self.session.commit()
+        self.messages = []
+        for listener in ["a.listener", "b.listener", None]:
+            message = EnqueuedMessage(content="hi", estimated_time=5, queue_id=self.queue.id, recipient_email="a@b.c", subject="hi", response_listener=listener)
+            self.session.add(message)
+            self.messages.append(message)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.remove()
+        patch.stopall()
+
+    def use_client(self, gmail_client):
+        patch.object(message_queue.GmailClient, 'for_user', return_value=gmail_client).start()
+        commit = patch.object(self.session, 'commit', wraps=self.session.commit).start()
+        return commit
+
+    def test_batch_is_sent_with_one_client_and_recorded_in_one_commit(self):
+        # Given three pending messages, one of them for a thread that already has a listener
+        gmail_client = FakeGmailClient()
+        commit = self.use_client(gmail_client)
+
+        # When they are sent as one batch
+        num_sent = MessageQueue.send_batch(1, [(self.queue, message) for message in self.messages])
+
+        # Then every message went through the one client, and was recorded in a single commit
+        self.assertEqual(num_sent, 3)
+        self.assertEqual(gmail_client.sent, [message.id for message in self.messages])
+        self.assertEqual(commit.call_count, 1)
+        self.assertTrue(all(message.sent_at is not None for message in self.messages))
+        self.assertAlmostEqual(self.queue.decayed_load_minutes, 15, places=2)
+        # And listeners were added or replaced, while the message without one left its thread alone
+        listeners = {listener.gmail_thread_id: listener.listener_function for listener in self.session.query(EmailCommandListener).all()}
+        self.assertEqual(listeners, {"thread-1": "a.listener", "thread-2": "b.listener"})
+
+    def test_messages_sent_before_a_failure_are_still_recorded(self):
+        # Given a client that fails on the second message
+        self.use_client(FakeGmailClient(fail_on=self.messages[1].id))
+
+        # When the batch is sent
+        with self.assertRaises(ConnectionError):
+            MessageQueue.send_batch(1, [(self.queue, message) for message in self.messages])
+
+        # Then only the first message is marked as sent
+        self.session.expire_all()
+        self.assertEqual([message.sent_at is not None for message in self.messages], [True, False, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
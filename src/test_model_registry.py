@@ -0,0 +1,86 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import types
+import unittest
+from unittest.mock import patch
+from src.skills.model_registry import LazyProxy, ModelRegistry
+
+
+class FakeInstructor:
+    """Counts how often the model is constructed, slowly enough for threads to race"""
+    constructed = 0
+
+    def __init__(self, model_name):
+        time.sleep(0.05)
+        FakeInstructor.constructed += 1
+        self.model_name = model_name
+
+    def encode(self, pairs):
+        return []
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        FakeInstructor.constructed = 0
+        patch.dict(sys.modules, {'InstructorEmbedding': types.SimpleNamespace(INSTRUCTOR=FakeInstructor)}).start()
+        patch.object(ModelRegistry, '_embeddings_models', {}).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_importing_the_skills_does_not_load_the_model(self):
+        # When the modules that hold lazy models and collections are imported in a fresh interpreter
+        script = (
+            "import sys\n"
+            "import src.skills.base, src.skills.zettelkasten_skill, src.skills.bot_brain\n"
+            "from src.skills.model_registry import ModelRegistry\n"
+            "print(ModelRegistry.is_loaded(), ModelRegistry._chroma_client is None, 'InstructorEmbedding' in sys.modules)\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, "-c", script], cwd=root, capture_output=True, text=True, env=os.environ.copy())
+
+        # Then neither the model nor the Chroma client was loaded
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], "False True False")
+
+    def test_first_use_loads_the_model_once(self):
+        # Given a lazy model
+        model = LazyProxy(ModelRegistry.embeddings_model)
+        self.assertFalse(ModelRegistry.is_loaded())
+
+        # When it is used twice
+        model.encode([])
+        model.encode([])
+
+        # Then it was loaded once, on first use
+        self.assertEqual(FakeInstructor.constructed, 1)
+        self.assertTrue(ModelRegistry.is_loaded())
+
+    def test_concurrent_first_uses_share_one_instance(self):
+        # Given a lazy proxy whose factory is slow and counts its calls
+        calls = []
+        def factory():
+            calls.append(1)
+            return ModelRegistry.embeddings_model()
+        model = LazyProxy(factory)
+
+        # When several threads use it at the same time
+        names = []
+        threads = [threading.Thread(target=lambda: names.append(id(model._resolve()))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Then the factory ran once and every thread got the same model
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(FakeInstructor.constructed, 1)
+        self.assertEqual(len(set(names)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+import numpy as np
+import src.skills.zettel.topic_maintenance as topic_maintenance
+from src.skills.zettel.topic_maintenance import TopicMaintenanceService
+
+
+class TestTopicMaintenanceService(unittest.TestCase):
+
+    def setUp(self):
+        # Given two topics, each the mean of the zettels assigned to it so far
+        rng = np.random.default_rng(0)
+        self.members = [rng.normal(size=(3, 8)).astype(np.float32) + 5, rng.normal(size=(4, 8)).astype(np.float32) - 5]
+        self.centroids = np.vstack([members.mean(axis=0) for members in self.members])
+        self.counts = np.array([3, 4], dtype=np.int64)
+
+    def test_new_zettels_go_to_the_nearest_centroid(self):
+        # When zettels close to each topic are assigned
+        embeddings = np.vstack([self.members[1][0] + 0.1, self.members[0][0] - 0.1])
+        labels = TopicMaintenanceService.nearest_centroids(embeddings, self.centroids)
+
+        # Then each joins the topic it is closest to
+        self.assertEqual(labels.tolist(), [1, 0])
+
+    def test_running_mean_matches_recomputed_mean(self):
+        # When one zettel is added to the first topic and one removed from the second
+        new_embedding = np.full((1, 8), 3.0, dtype=np.float32)
+        TopicMaintenanceService.add_to_centroids(self.centroids, self.counts, np.array([0]), new_embedding)
+        TopicMaintenanceService.remove_from_centroid(self.centroids, self.counts, 1, self.members[1][0])
+
+        # Then the centroids equal the means recomputed from scratch
+        np.testing.assert_allclose(self.centroids[0], np.vstack([self.members[0], new_embedding]).mean(axis=0), rtol=1e-5)
+        np.testing.assert_allclose(self.centroids[1], self.members[1][1:].mean(axis=0), rtol=1e-5)
+        self.assertEqual(self.counts.tolist(), [4, 3])
+
+    def test_removing_the_last_zettel_empties_the_topic(self):
+        # Given a topic with a single zettel
+        self.counts[0] = 1
+        centroid = self.centroids[0].copy()
+
+        # When it is removed
+        TopicMaintenanceService.remove_from_centroid(self.centroids, self.counts, 0, centroid)
+
+        # Then the topic is empty and keeps its last centroid
+        self.assertEqual(self.counts[0], 0)
+        np.testing.assert_array_equal(self.centroids[0], centroid)
+
+
+class TestUpdateTopics(unittest.TestCase):
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_emptied_topics_are_deleted_before_zettels_are_assigned(self):
+        # Given two topics, the first of which loses its only zettel
+        centroid = np.array([1.0, 0.0], dtype=np.float32)
+        emptied = SimpleNamespace(id=1, centroid_instructor_base_embedding=centroid, zettel_count=1, drift=0.0)
+        other = SimpleNamespace(id=2, centroid_instructor_base_embedding=np.array([0.0, 1.0], dtype=np.float32), zettel_count=3, drift=0.0)
+        session = MagicMock()
+        session.query.return_value.filter_by.return_value.order_by.return_value.all.return_value = [emptied, other]
+        patch.object(topic_maintenance, 'db_session', session).start()
+        # And a changed zettel that is closest to the emptied topic's old centroid
+        patch.object(topic_maintenance, 'load_vector_matrix', return_value=(np.array([9]), np.array([[1.0, 0.1]], dtype=np.float32))).start()
+        assign = patch.object(topic_maintenance.ZettelkastenTopic, 'assign_zettels_to_topics').start()
+        patch.object(TopicMaintenanceService, 'refresh_summaries').start()
+
+        # When the topics are updated
+        TopicMaintenanceService(user_id=3).update_topics([9], [(1, centroid)])
+
+        # Then the emptied topic is deleted and the zettel joins the remaining one
+        session.delete.assert_called_once_with(emptied)
+        self.assertEqual(assign.call_args.args[3], [2])
+        self.assertEqual(other.zettel_count, 4)
+
+
+class TestRefreshSummaries(unittest.TestCase):
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_summaries_are_generated_outside_a_transaction(self):
+        # Given a topic to re-summarize and a session that records what happens
+        events = []
+        topic = SimpleNamespace(id=7, centroid_instructor_base_embedding=np.zeros(4), description=None, name=None, drift=0.3)
+        session = MagicMock()
+        session.query.return_value.filter.return_value.order_by.return_value.all.return_value = [topic]
+        session.commit.side_effect = lambda: events.append("commit")
+        session.get.side_effect = lambda _model, topic_id: events.append("get") or topic
+        patch.object(topic_maintenance, 'db_session', session).start()
+        zettel = SimpleNamespace(title="t", content="c")
+        vector_search = patch.object(topic_maintenance.Zettel, 'vector_search', return_value=[(zettel, 0.9)]).start()
+        summarizer = patch.object(topic_maintenance, 'TopicSummarizer').start()
+        summarizer.return_value.summarize_many.side_effect = lambda groups: events.append("summarize") or [("summary", "name")]
+
+        # When its summary is refreshed
+        TopicMaintenanceService(user_id=3).refresh_summaries([7])
+
+        # Then the read transaction ended before the LLM call, and the result was saved in a new one
+        self.assertEqual(events, ["commit", "summarize", "get", "commit"])
+        self.assertEqual((topic.description, topic.name, topic.drift), ("summary", "name", 0.0))
+        # And only the topic owner's zettels were searched
+        self.assertEqual(vector_search.call_args.kwargs["user_id"], 3)
+
+    def test_drift_is_reset_even_when_summarizing_fails(self):
+        # Given a drifted topic and a summarizer that fails
+        topic = SimpleNamespace(id=7, centroid_instructor_base_embedding=np.zeros(4), description=None, name=None, drift=0.3)
+        session = MagicMock()
+        session.query.return_value.filter.return_value.order_by.return_value.all.return_value = [topic]
+        patch.object(topic_maintenance, 'db_session', session).start()
+        patch.object(topic_maintenance.Zettel, 'vector_search', return_value=[]).start()
+        summarizer = patch.object(topic_maintenance, 'TopicSummarizer').start()
+        summarizer.return_value.summarize_many.side_effect = RuntimeError("overloaded")
+
+        # When its summary is refreshed
+        with self.assertRaises(RuntimeError):
+            TopicMaintenanceService(user_id=3).refresh_summaries([7])
+
+        # Then its drift was reset and committed before the call, so the next sync does not rebalance it again
+        self.assertEqual(topic.drift, 0.0)
+        session.commit.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import asyncio
+import re
+import unittest
+from types import SimpleNamespace
+import anthropic
+import httpx
+from src.skills.zettel.topic_summarizer import TopicSummarizer
+
+
+class StubMessages:
+    """
+    Answers "summary of <title>" then "name of <title>" for the group's first
+    zettel, failing the first `failures` calls with a connection error.
+    Groups listed in `delays` take that many seconds, so they can finish out of order.
+    """
+    def __init__(self, failures=0, delays=None):
+        self.failures = failures
+        self.delays = delays or {}
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def create(self, messages, **kwargs):
+        self.calls += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise anthropic.APIConnectionError(request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+        title = re.search(r"\[\[(.+?)\]\]", messages[0]["content"]).group(1)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delays.get(title, 0.01))
+        self.in_flight -= 1
+        kind = "name" if len(messages) > 1 else "summary"
+        return SimpleNamespace(content=[SimpleNamespace(text=f"{kind} of {title}")])
+
+
+def zettel(title):
+    return SimpleNamespace(title=title, content="content of " + title)
+
+
+class TestTopicSummarizer(unittest.TestCase):
+
+    def test_summarizes_every_group_in_order(self):
+        # Given a stub client on which earlier groups answer more slowly, and three groups of zettels
+        messages = StubMessages(delays={"a": 0.05, "b": 0.03, "c": 0.01})
+        groups = [[zettel("a")], [zettel("b")], [zettel("c")]]
+
+        # When they are summarized with at most two topics in flight
+        results = TopicSummarizer(client=SimpleNamespace(messages=messages), max_concurrency=2).summarize_many(groups)
+
+        # Then each group gets its own summary and name, in the original order
+        self.assertEqual(results, [
+            ("summary of a", "name of a"),
+            ("summary of b", "name of b"),
+            ("summary of c", "name of c"),
+        ])
+        self.assertEqual(messages.calls, 6)
+        # And no more than two requests ran at once
+        self.assertEqual(messages.max_in_flight, 2)
+
+    def test_retries_connection_errors(self):
+        # Given a client whose first two requests fail
+        messages = StubMessages(failures=2)
+
+        # When a group is summarized
+        results = TopicSummarizer(client=SimpleNamespace(messages=messages), base_delay=0).summarize_many([[zettel("a")]])
+
+        # Then the failed requests were retried
+        self.assertEqual(len(results), 1)
+        self.assertEqual(messages.calls, 4)
+
+    def test_gives_up_after_max_retries(self):
+        # Given a client that keeps failing
+        messages = StubMessages(failures=10)
+
+        # When a group is summarized
+        # Then the error is raised once the retries run out
+        with self.assertRaises(anthropic.APIConnectionError):
+            TopicSummarizer(client=SimpleNamespace(messages=messages), max_retries=2, base_delay=0).summarize_many([[zettel("a")]])
+        self.assertEqual(messages.calls, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()